@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import io
+import time
+import json
+import argparse
+import contextlib
+import concurrent.futures
+import epub2html
+
+
+def find_epubs(paths):
+    """Expands paths into a list of epub files. Directories are searched
+    recursively for files ending in .epub."""
+    epubs = []
+    for p in paths:
+        if os.path.isdir(p):
+            for dirpath, dirnames, filenames in os.walk(p):
+                dirnames.sort()
+                epubs.extend(os.path.join(dirpath, X) for X in sorted(filenames)
+                             if X.lower().endswith(".epub"))
+        else:
+            epubs.append(p)
+    return epubs
+
+
+def output_dirs(epubs, output_dir):
+    """Gives each epub its own directory in output_dir, named after the
+    epub. Books with the same name get a numbered suffix."""
+    dirs, used = [], set()
+    for epub in epubs:
+        name = os.path.splitext(os.path.basename(epub))[0]
+        d, c = os.path.join(output_dir, name), 0
+        while d in used:
+            c += 1
+            d = os.path.join(output_dir, "%s(%s)" % (name, c))
+        used.add(d)
+        dirs.append(d)
+    return dirs
+
+
+def convert_book(epub, output_dir):
+    """Converts a single book, returning a summary record. Any failure
+    is recorded rather than raised, so that one bad book doesn't stop
+    the batch. The per-file progress output of epub2html is
+    discarded."""
+    record = {"epub": epub, "output": output_dir}
+    start = time.time()
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            record.update(epub2html.convert(epub, output_dir))
+        record["status"] = "ok"
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = "%s: %s" % (type(e).__name__, e)
+    record["seconds"] = round(time.time() - start, 3)
+    return record
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description=("Convert a batch of epubs with epub2html.py. Each book is "
+                     "written to its own directory in the output directory."))
+    parser.add_argument("paths", nargs="+", help="Epub files or directories containing them")
+    parser.add_argument("-o", "--output", default=".",
+                        help="Output directory (default: current directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of books to convert at once (default: number of CPUs)")
+    parser.add_argument("-s", "--summary",
+                        help=("File to write a JSON summary of the batch to "
+                              "(default: summary.json in the output directory)"))
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    epubs = find_epubs(args["paths"])
+    if not epubs:
+        print("No epubs found")
+        sys.exit(-1)
+    dirs = output_dirs(epubs, args["output"])
+    start = time.time()
+    records = [None] * len(epubs)
+    with concurrent.futures.ProcessPoolExecutor(args["jobs"]) as executor:
+        futures = {executor.submit(convert_book, epub, d): c
+                   for c, (epub, d) in enumerate(zip(epubs, dirs))}
+        for future in concurrent.futures.as_completed(futures):
+            r = future.result()
+            records[futures[future]] = r
+            if r["status"] == "ok":
+                print("Converted %s (%d groups, %d bytes) in %.2fs" %
+                      (r["epub"], r["groups"], r["bytes"], r["seconds"]))
+            else:
+                print("Failed %s: %s" % (r["epub"], r["error"]))
+    failed = sum(1 for X in records if X["status"] != "ok")
+    summary = {"books": records,
+               "converted": len(records) - failed,
+               "failed": failed,
+               "seconds": round(time.time() - start, 3)}
+    summary_filename = args["summary"] or os.path.join(args["output"], "summary.json")
+    os.makedirs(os.path.dirname(summary_filename) or ".", exist_ok=True)
+    with open(summary_filename, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=1)
+    print("Converted %d of %d books in %.2fs, summary written to %s" %
+          (len(records) - failed, len(records), summary["seconds"], summary_filename))
+    if failed: sys.exit(1)
+
+
+if __name__ == "__main__": main()
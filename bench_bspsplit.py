@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+import gc
+import os
+import sys
+import time
+import random
+import filecmp
+import tempfile
+import argparse
+import subprocess
+import common
+import bspsplit
+
+#Times bspsplit.py end to end, with and without --strip_empty, and the
+#steps of splitting a tree in memory, on a book given or generated. If
+#another copy of the tools is given with --compare (e.g. a git worktree of
+#an older commit), its bspsplit.py is timed too and the outputs compared.
+
+#(weight, paragraph) of the paragraphs of a generated book, %d being the
+#paragraph number
+paragraphs = [
+    (830, '<p>Plain paragraph number %d with some <i>italic</i> and <b>bold <em>nested</em></b> '
+          'text.</p>\n'),
+    (30, '<p>sup %d<sup>1</sup></p>\n'),
+    (30, '<p class="noindent">Classed %d</p>\n'),
+    (30, '<p class="other">Other class %d</p>\n'),
+    (30, '<p style="color:red">styled %d</p>\n'),
+    (20, '<p>x %d <img src="a.png"/></p>\n'),
+    (20, '<p> </p>\n'),
+    (10, '<p>\n<i>\n</i>\n</p>\n'),
+    (10, '<p><br/></p>\n'),
+    (10, '<p>deep <i><b><i><b>%d</b></i></b></i><br/>line</p>\n'),
+    (10, '<blockquote><p>Quoted %d</p><p>\n</p></blockquote>\n'),
+    (10, '<p>outer %d <span><p>inner</p></span></p>\n'),
+    (10, '<p>with comment %d <!-- c --></p>\n'),
+    (10, '<div class="chapter"><h2>Chap %d</h2><p>First</p></div>\n'),
+]
+
+
+def make_book(filename, n, seed=0):
+    """Writes a book of n paragraphs of the kinds in paragraphs."""
+    random.seed(seed)
+    weights = [X[0] for X in paragraphs]
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml">\n'
+                '<head>\n<title>T</title>\n</head>\n<body>\n')
+        for c, (w, p) in enumerate(random.choices(paragraphs, weights, k=n)):
+            f.write(p % c if "%d" in p else p)
+        f.write('</body>\n</html>\n')
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description="Time bspsplit.py on a book, by default a generated one.")
+    parser.add_argument("input", nargs="?",
+                        help="xhtml file to split (default: generate a book)")
+    parser.add_argument("-g", "--generate", type=int, default=100000,
+                        help="Number of paragraphs in the generated book (default: 100000)")
+    parser.add_argument("--compare", metavar="DIR",
+                        help="Directory of another copy of the tools to time against")
+    parser.add_argument("-n", "--repeat", type=int, default=5,
+                        help="Runs of each step, the best being reported (default: 5)")
+    return vars(parser.parse_args())
+
+
+def time_steps(filename, argv, repeat):
+    """Returns the best times of the steps of bspsplit.split_tree."""
+    args = bspsplit.parse_command_line(argv + [filename])
+    best = {}
+    for r in range(repeat):
+        body = common.parse_xhtml(filename).getroot().find("{http://www.w3.org/1999/xhtml}body")
+        gc.collect()
+        gc.disable()
+        try:
+            times, fail = [], []
+            start = time.perf_counter()
+            bsp_el, parents = bspsplit.process_bsps(body, bspsplit.bsp_rules(args), fail)
+            times.append(("classify+extract", time.perf_counter() - start))
+            start = time.perf_counter()
+            bspsplit.remove_subelements(parents, [X[0] for X in fail if X[1] == "empty"])
+            times.append(("strip empty", time.perf_counter() - start))
+            start = time.perf_counter()
+            bspsplit.collapse_placeholders(body, bspsplit.make_href(args))
+            times.append(("collapse_placeholders", time.perf_counter() - start))
+        finally:
+            gc.enable()
+        for name, t in times:
+            best[name] = min(best.get(name, t), t)
+    return best
+
+
+def main():
+    args = parse_command_line()
+    argv = ["-t", "sup", "-c", "noindent"]
+    tools = {"this": os.path.dirname(os.path.abspath(__file__))}
+    if args["compare"]: tools["compare"] = os.path.abspath(args["compare"])
+    with tempfile.TemporaryDirectory() as work:
+        book = args["input"]
+        if not book:
+            book = os.path.join(work, "book.xhtml")
+            make_book(book, args["generate"])
+            print("Generated a book of %d paragraphs" % args["generate"])
+        book = os.path.abspath(book)
+        #keep bspsplit.py from using a running docserver.py
+        env = dict(os.environ, EBOOK_DOCSERVER=os.path.join(work, "no-server.sock"))
+        for extra in ([], ["-e"]):
+            outputs = []
+            for name, directory in tools.items():
+                out = os.path.join(work, name + "".join(extra))
+                os.mkdir(out)
+                start = time.perf_counter()
+                subprocess.run([sys.executable, os.path.join(directory, "bspsplit.py")] + argv +
+                               extra + [book], cwd=out, stdout=subprocess.DEVNULL, env=env,
+                               check=True)
+                print("%-8s bspsplit.py %-3s %7.2fs" % (name, " ".join(extra),
+                                                       time.perf_counter() - start))
+                outputs.append(out)
+            if len(outputs) > 1:
+                same = all(filecmp.cmp(os.path.join(outputs[0], X), os.path.join(outputs[1], X),
+                                       shallow=False) for X in ("skeleton.xhtml", "bsps.xhtml"))
+                print("Outputs are identical" if same else "Outputs differ")
+        for name, t in time_steps(book, argv, args["repeat"]).items():
+            print("%-30s %.3fs" % (name, t))
+
+
+if __name__ == "__main__": main()
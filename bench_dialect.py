@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import re
+import time
+import random
+import argparse
+import pretty_punc
+
+#Times pretty_punc.replace_dialect against dialect dictionaries of growing
+#size, on generated paragraphs in which some words are elided. The old
+#way, a regex per dialect word, is timed too for the smaller sizes.
+
+
+def old_replace_dialect(p, dialect):
+    #as replace_dialect was before the single scan
+    for k in dialect:
+        p = re.sub("(^|\\W)%s($|\\W)" % k, "\\1%s\\2" % dialect[k], p)
+    return p
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description="Time dialect replacement against dialect dictionary size.")
+    parser.add_argument("sizes", nargs="*", type=int, default=[10, 100, 1000, 10000],
+                        help="Dictionary sizes (default: 10 100 1000 10000)")
+    parser.add_argument("-p", "--paras", type=int, default=500,
+                        help="Number of 80 word paragraphs (default: 500)")
+    parser.add_argument("--old-max", type=int, default=1000,
+                        help="Largest size to time the old way for (default: 1000)")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    random.seed(1)
+    words = list(dict.fromkeys("".join(random.choice("abcdefghij")
+                                       for _ in range(random.randint(3, 7)))
+                               for _ in range(max(args["sizes"]) * 3)))
+    #dialect forms elided at the start ('em) and at the end (nothin'), the
+    #latter also straight after an opening quote ('nothin' doin')
+    forms = [("'" + X) if c % 2 else (X + "'") for c, X in enumerate(words)]
+    def token():
+        r = random.random()
+        if r < 0.8: return random.choice(words)
+        form = random.choice(forms[:min(args["sizes"]) * 2])
+        if r < 0.95 or form[0] == "'": return form
+        return "'" + form
+    paras = [" ".join(token() for _ in range(80)) for _ in range(args["paras"])]
+    print("%8s %10s %10s %10s" % ("size", "old", "new", "changed"))
+    for n in args["sizes"]:
+        #half of the forms used in the text are dialect at every size
+        dialect = {X: X.replace("'", "ʼ") for X in forms[:min(args["sizes"]) * 2:2]}
+        dialect.update({X: X.replace("'", "ʼ") for X in forms[len(dialect) * 2:][:n - len(dialect)]})
+        start = time.perf_counter()
+        new = [pretty_punc.replace_dialect(X, dialect) for X in paras]
+        t_new = time.perf_counter() - start
+        t_old = "-"
+        if n <= args["old_max"]:
+            start = time.perf_counter()
+            old = [old_replace_dialect(X, dialect) for X in paras]
+            t_old = "%.3fs" % (time.perf_counter() - start)
+            if old != new: t_old += " (differs)"
+        changed = sum(X != Y for X, Y in zip(paras, new))
+        print("%8d %10s %9.3fs %10d" % (n, t_old, t_new, changed))
+        assert changed, "no dialect words were replaced"
+
+
+if __name__ == "__main__": main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import re
+import time
+import random
+import argparse
+import html.entities
+import xml.etree.ElementTree as ET
+import common
+
+#Times common.fix_entities, whole and over chunks, on generated text full
+#of named and numeric character references, against the two decoders it
+#replaced, and checks that the parsed results are the same.
+
+skip = ("quot", "amp", "apos", "lt", "gt")
+
+
+def old_common_fix_entities(text):
+    #as common.fix_entities was, less its deletions from entitydefs: a
+    #replace over the whole text for each name
+    repl = html.entities.entitydefs
+    for e in repl:
+        if e not in skip: text = text.replace("&" + e + ";", repl[e])
+    return text
+
+
+def old_epub2html_fix_entities(text):
+    #as epub2html.fix_entities was: a replace for each name used
+    entities = set(re.findall(r"&(\w+);", text)) - set(skip)
+    for e in entities:
+        text = text.replace("&" + e + ";", chr(html.entities.name2codepoint[e]))
+    return text
+
+
+def make_text(words):
+    random.seed(3)
+    names = [X for X in html.entities.name2codepoint if X not in skip]
+    parts = []
+    for i in range(words):
+        parts.append("word ")
+        if i % 7 == 0: parts.append("&%s;" % random.choice(names))
+        if i % 50 == 0: parts.append("&#8220;&#x201D;&amp;&lt;&#38;")
+    return "".join(parts)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description="Time entity decoding on generated text, against the old decoders.")
+    parser.add_argument("-w", "--words", type=int, default=400000,
+                        help="Words of text to generate (default: 400000, about 2.6MB)")
+    parser.add_argument("-c", "--chunk", type=int, default=1000,
+                        help="Chunk size for iter_fix_entities (default: 1000)")
+    return vars(parser.parse_args())
+
+
+def parsed(text):
+    return ET.tostring(ET.XML("<r>" + text + "</r>"))
+
+
+def main():
+    args = parse_command_line()
+    text = make_text(args["words"])
+    print("%.1fMB, %d references" % (len(text) / 1e6, text.count("&")))
+    results = []
+    def run(name, f):
+        start = time.perf_counter()
+        results.append(f(text))
+        print("%-28s %.3fs" % (name, time.perf_counter() - start))
+    run("old common.fix_entities", old_common_fix_entities)
+    run("old epub2html.fix_entities", old_epub2html_fix_entities)
+    run("fix_entities", common.fix_entities)
+    run("iter_fix_entities, chunked", lambda t: "".join(common.iter_fix_entities(
+        t[X:X + args["chunk"]] for X in range(0, len(t), args["chunk"]))))
+    same = all(parsed(X) == parsed(results[0]) for X in results[1:])
+    print("Parsed results are identical" if same else "Parsed results differ")
+
+
+if __name__ == "__main__": main()
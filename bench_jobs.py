@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import filecmp
+import tempfile
+import argparse
+import subprocess
+
+#Times pretty_punc.py on a book with different numbers of jobs, reporting
+#the speedup over a single job, and checks that the results are the same.
+#The book is worked on in a temporary directory and no questions are asked.
+#The speedup can only be seen on a machine with more than one CPU.
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description="Time pretty_punc.py on a book with --jobs 1, 2, 4, .. up to the maximum.")
+    parser.add_argument("input", help="xhtml file to work on (it is not changed)")
+    parser.add_argument("-m", "--max-jobs", type=int, default=os.cpu_count() or 1,
+                        help="Largest number of jobs to try (default: number of CPUs)")
+    parser.add_argument("-n", "--repeat", type=int, default=1,
+                        help="Runs of each number of jobs, the best being reported (default: 1)")
+    parser.add_argument("-a", "--args", default="",
+                        help="Further arguments for pretty_punc.py, as a single argument")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    tools = os.path.dirname(os.path.abspath(__file__))
+    jobs = [1]
+    while jobs[-1] * 2 <= args["max_jobs"]: jobs.append(jobs[-1] * 2)
+    if jobs[-1] != args["max_jobs"]: jobs.append(args["max_jobs"])
+    print("%d CPUs" % (os.cpu_count() or 1))
+    with tempfile.TemporaryDirectory() as work:
+        base, outputs = None, []
+        for j in jobs:
+            best = None
+            for r in range(args["repeat"]):
+                book = os.path.join(work, "book-j%d.xhtml" % j)
+                shutil.copyfile(args["input"], book)
+                if os.path.exists(book + ".old"): os.remove(book + ".old")
+                start = time.perf_counter()
+                subprocess.run([sys.executable, os.path.join(tools, "pretty_punc.py"), book,
+                                "--replay-only", "--no-journal", "-j", str(j)] +
+                               shlex.split(args["args"]), stdout=subprocess.DEVNULL, check=True)
+                t = time.perf_counter() - start
+                if best is None or t < best: best = t
+            if base is None: base = best
+            outputs.append(book)
+            print("-j %-3d %8.2f s  speedup %.2f" % (j, best, base / best))
+        if all(filecmp.cmp(outputs[0], X, shallow=False) for X in outputs[1:]):
+            print("Outputs are identical")
+        else:
+            print("Outputs differ")
+
+
+if __name__ == "__main__": main()
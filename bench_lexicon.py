@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+import os
+import time
+import random
+import tempfile
+import argparse
+import lexicon
+import pretty_punc
+
+#Times the lexicon as it grows: looking up a form, loading the dialect
+#forms as pretty_punc's dictionary, replacing dialect in a paragraph with
+#that dictionary and a prefix and a suffix search. Lexicons of random
+#forms are built in a temporary directory.
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Time lexicon operations against lexicon size.")
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 10000, 50000],
+                        help="Numbers of forms (default: 1000 10000 50000)")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    random.seed(2)
+    print("%8s %10s %10s %12s %14s %10s" % ("forms", "lookup", "load", "dialect/para",
+                                             "prefix+suffix", "record"))
+    with tempfile.TemporaryDirectory() as work:
+        for n in args["sizes"]:
+            lx = lexicon.Lexicon(os.path.join(work, "lexicon%d.sqlite" % n))
+            forms = ["'" + "".join(random.choice("abcdefghijklmnop")
+                                   for _ in range(random.randint(3, 8))) for _ in range(n)]
+            start = time.perf_counter()
+            lx.record_book("b", [(X, "d") for X in forms])
+            t_record = time.perf_counter() - start
+            probe = random.sample(forms, min(n, 1000))
+            start = time.perf_counter()
+            for f in probe: lx.lookup(f)
+            t_lookup = (time.perf_counter() - start) / len(probe)
+            start = time.perf_counter()
+            dialect = lx.dialect_forms("b")
+            t_load = time.perf_counter() - start
+            text = " ".join(random.choice(forms) for _ in range(100))
+            start = time.perf_counter()
+            for i in range(1000): pretty_punc.replace_dialect(text, dialect)
+            t_para = (time.perf_counter() - start) / 1000
+            start = time.perf_counter()
+            lx.prefixed("'ab")
+            lx.suffixed("op")
+            t_search = time.perf_counter() - start
+            lx.close()
+            print("%8d %8.1fus %9.3fs %10.0fus %12.2fms %9.2fs" % (
+                n, t_lookup * 1e6, t_load, t_para * 1e6, t_search * 1e3, t_record))
+
+
+if __name__ == "__main__": main()
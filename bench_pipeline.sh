@@ -0,0 +1,60 @@
+#!/bin/bash
+
+#Times the tools run one after the other from the shell against pipeline.py
+#doing the same work in one process, and checks that the results match.
+#The books are worked on in a temporary directory and pretty_punc asks no
+#questions.
+
+if [ $# -lt 1 -o ! -r "$1" ]
+then
+    echo "Usage: $0 HTMLFILE [RULESFILE]"
+    exit -1
+fi
+
+TOOLS="$(cd "$(dirname "$0")" && pwd)"
+WORK="$(mktemp -d)"
+trap 'rm -rf "$WORK"' EXIT
+mkdir "$WORK/shell" "$WORK/pipeline"
+cp "$1" "$WORK/shell/book.xhtml"
+cp "$1" "$WORK/pipeline/book.xhtml"
+RT_ARGS=""
+if [ -n "$2" ]
+then
+    cp "$2" "$WORK/rules.txt"
+    RT_ARGS="-f $WORK/rules.txt -y"
+fi
+PP_ARGS="--replay-only --no-journal"
+#keep the tools from handing their work to a running docserver.py
+export EBOOK_DOCSERVER="$WORK/no-server.sock"
+TIMEFORMAT="%R s"
+
+echo "Shell flow:"
+time (
+    cd "$WORK/shell"
+    if [ -n "$RT_ARGS" ]
+    then
+        python3 "$TOOLS/replace_tag.py" book.xhtml $RT_ARGS
+    fi
+    python3 "$TOOLS/bspsplit.py" book.xhtml -o skeleton.xhtml -b bsps.xhtml
+    python3 "$TOOLS/haines_poem.py" skeleton.xhtml
+    python3 "$TOOLS/pretty_punc.py" bsps.xhtml $PP_ARGS
+    python3 "$TOOLS/recombine.py" -s skeleton.xhtml -b bsps.xhtml -o recombined.xhtml --notitle
+) > "$WORK/shell.log"
+
+echo "Pipeline:"
+time (
+    cd "$WORK/pipeline"
+    python3 "$TOOLS/pipeline.py" book.xhtml -o recombined.xhtml ${RT_ARGS:+--replace-tag="$RT_ARGS"} \
+            --bspsplit="" --haines-poem --pretty-punc="$PP_ARGS" --notitle
+) > "$WORK/pipeline.log"
+
+if cmp -s "$WORK/shell/recombined.xhtml" "$WORK/pipeline/recombined.xhtml"
+then
+    echo "Outputs are identical"
+else
+    python3 -c "
+import sys, xml.etree.ElementTree as ET
+a, b = (ET.canonicalize(from_file=X) for X in sys.argv[1:])
+print('Outputs differ only in serialization' if a == b else 'Outputs differ')
+" "$WORK/shell/recombined.xhtml" "$WORK/pipeline/recombined.xhtml"
+fi
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+import time
+import argparse
+import pretty_punc
+
+#Times pretty_punc's single quote processing on long paragraphs, which is
+#where its cost used to grow with the square of the paragraph length. No
+#questions are asked: quotes without an answer are left marked, as with
+#--replay-only.
+
+inputs = {
+    #each section ends in a closing quote that is really an apostrophe, so
+    #is put back and queried
+    "apostrophes": "goin' ",
+    #no closing quotes, so the paragraph is one section with every quote
+    #queried
+    "openers": "'a b ",
+}
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description="Time pretty_punc's processing of paragraphs of many single quotes.")
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 2000, 4000],
+                        help="Numbers of quotes per paragraph (default: 1000 2000 4000)")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="Runs of each size, the best being reported (default: 3)")
+    return vars(parser.parse_args())
+
+
+def time_para(p, repeat):
+    best = None
+    for i in range(repeat):
+        journal = pretty_punc.Journal(replay_only=True)
+        start = time.perf_counter()
+        pretty_punc.process_para(p, {}, journal)
+        t = time.perf_counter() - start
+        if best is None or t < best: best = t
+    return best
+
+
+def main():
+    args = parse_command_line()
+    for name, unit in inputs.items():
+        for n in args["sizes"]:
+            print("%-12s %6d quotes: %.3f s" % (name, n, time_para(unit * n, args["repeat"])))
+
+
+if __name__ == "__main__": main()
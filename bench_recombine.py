@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import subprocess
+import xml.etree.ElementTree as ET
+import common
+import bspindex
+import recombine
+import bench_bspsplit
+
+#Times recombine.py end to end, and its recombination on its own, on a
+#book given or generated, split by bspsplit.py first. If another copy of
+#the tools is given with --compare (e.g. a git worktree of an older
+#commit), it splits the book and recombines it with its own tools too,
+#and the results are compared.
+
+#runs a command, printing its peak memory use on stderr
+measure = """\
+import sys, subprocess, resource
+subprocess.run(sys.argv[1:], stdout=subprocess.DEVNULL, check=True)
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss, file=sys.stderr)
+"""
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description="Time recombine.py on a book, by default a generated one.")
+    parser.add_argument("input", nargs="?",
+                        help="xhtml file to split and recombine (default: generate a book)")
+    parser.add_argument("-g", "--generate", type=int, default=100000,
+                        help="Number of paragraphs in the generated book (default: 100000)")
+    parser.add_argument("--compare", metavar="DIR",
+                        help="Directory of another copy of the tools to time against")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="Runs of the recombination on its own (default: 3)")
+    return vars(parser.parse_args())
+
+
+def time_recombine(out, repeat):
+    """Returns the best times of recombining the split book in out, as
+    recombine.py does and in memory as pipeline.py does, less parsing and
+    writing."""
+    args = {"skeleton": os.path.join(out, "skeleton.xhtml"), "notitle": True,
+            "output": os.devnull}
+    best = {}
+    for r in range(repeat):
+        start = time.perf_counter()
+        bsps = bspindex.BspFile(os.path.join(out, "bsps.xhtml"))
+        recombine.recombine(args, bsps)
+        bsps.close()
+        t = time.perf_counter() - start
+        best["recombine (streamed)"] = min(best.get("recombine (streamed)", t), t)
+        skeleton = common.parse_xhtml(args["skeleton"])
+        bsp_tree = common.parse_xhtml(os.path.join(out, "bsps.xhtml"))
+        start = time.perf_counter()
+        recombine.recombine_tree(skeleton, bsp_tree, True)
+        t = time.perf_counter() - start
+        best["recombine_tree"] = min(best.get("recombine_tree", t), t)
+    return best
+
+
+def main():
+    args = parse_command_line()
+    ET.register_namespace('', "http://www.w3.org/1999/xhtml")
+    tools = {"this": os.path.dirname(os.path.abspath(__file__))}
+    if args["compare"]: tools["compare"] = os.path.abspath(args["compare"])
+    with tempfile.TemporaryDirectory() as work:
+        book = args["input"]
+        if not book:
+            book = os.path.join(work, "book.xhtml")
+            bench_bspsplit.make_book(book, args["generate"])
+            print("Generated a book of %d paragraphs" % args["generate"])
+        book = os.path.abspath(book)
+        #keep bspsplit.py from using a running docserver.py
+        env = dict(os.environ, EBOOK_DOCSERVER=os.path.join(work, "no-server.sock"))
+        outputs = []
+        for name, directory in tools.items():
+            out = os.path.join(work, name)
+            os.mkdir(out)
+            subprocess.run([sys.executable, os.path.join(directory, "bspsplit.py"), book],
+                           cwd=out, stdout=subprocess.DEVNULL, env=env, check=True)
+            start = time.perf_counter()
+            r = subprocess.run([sys.executable, "-c", measure, sys.executable,
+                                os.path.join(directory, "recombine.py"), "--notitle"],
+                               cwd=out, stderr=subprocess.PIPE, text=True, check=True)
+            print("%-8s recombine.py %7.2fs %6dMB" % (name, time.perf_counter() - start,
+                                                     int(r.stderr.split()[-1]) // 1024))
+            outputs.append(os.path.join(out, "recombined.xhtml"))
+        if len(outputs) > 1:
+            a, b = (ET.canonicalize(from_file=X) for X in outputs)
+            print("Outputs are the same" if a == b else "Outputs differ")
+        for name, t in time_recombine(os.path.join(work, "this"), args["repeat"]).items():
+            print("%-30s %.3fs" % (name, t))
+
+
+if __name__ == "__main__": main()
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import re
+import json
+import mmap
+import array
+import hashlib
+import argparse
+import xml.parsers.expat
+import xml.etree.ElementTree as ET
+
+#The index of bsps.xhtml is kept in bsps.xhtml.idx. This holds a line of
+#JSON recording the size and sha256 digest of the bsps file it was built
+#from and the namespace declarations of its root element, followed by a
+#table of (start, end) byte offsets of the div for each bsp, as pairs of
+#little-endian 64 bit integers indexed by bsp number. Numbers with no bsp
+#have offsets of (0, 0).
+
+re_bsp_id = re.compile(r"bsp(\d+)$")
+
+
+def index_filename(filename):
+    return filename + ".idx"
+
+
+def build_index(filename):
+    """Scans a bsps file, returning its index as (header, offsets)."""
+    header = {"size": os.path.getsize(filename), "namespaces": {}}
+    offsets = array.array("q")
+    with open(filename, "rb") as f:
+        header["sha256"] = hashlib.file_digest(f, "sha256").hexdigest()
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        parser = xml.parsers.expat.ParserCreate()
+        stack = []
+        def start_element(name, attrs):
+            if not stack:
+                header["namespaces"] = {k: v for k, v in attrs.items()
+                                        if k == "xmlns" or k.startswith("xmlns:")}
+            #bsp divs are the children of the body
+            m = len(stack) == 2 and name == "div" and re_bsp_id.match(attrs.get("id", ""))
+            stack.append((int(m.group(1)), parser.CurrentByteIndex) if m else None)
+        def end_element(name):
+            bsp = stack.pop()
+            if bsp:
+                n, start = bsp
+                if n >= len(offsets) // 2:
+                    offsets.extend([0, 0] * (n + 1 - len(offsets) // 2))
+                offsets[2 * n] = start
+                offsets[2 * n + 1] = mm.find(b">", parser.CurrentByteIndex) + 1
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.Parse(mm, True)
+    return header, offsets
+
+
+def write_index(filename):
+    """Builds the index for a bsps file and writes it alongside the file."""
+    header, offsets = build_index(filename)
+    with open(index_filename(filename), "wb") as f:
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        if sys.byteorder == "big":
+            offsets = array.array("q", offsets)
+            offsets.byteswap()
+        f.write(offsets.tobytes())
+
+
+def read_header(f):
+    """Reads the header of an index file, returning it and the offset of
+    the table."""
+    header = json.loads(f.readline())
+    return header, f.tell()
+
+
+def index_current(filename):
+    """True if the index of a bsps file exists and was built from the file
+    as it is now."""
+    try:
+        with open(index_filename(filename), "rb") as f:
+            header, table_start = read_header(f)
+        if header["size"] != os.path.getsize(filename): return False
+        with open(filename, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest() == header["sha256"]
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+class BspFile:
+    """Random access to the bsps in a bsps file, through its index. The
+    index is rebuilt first if the bsps file has changed since it was
+    written."""
+
+    def __init__(self, filename):
+        if not index_current(filename): write_index(filename)
+        self.idx_f = open(index_filename(filename), "rb")
+        self.header, self.table_start = read_header(self.idx_f)
+        self.idx = mmap.mmap(self.idx_f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = (len(self.idx) - self.table_start) // 16
+        self.f = open(filename, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.namespace_decls = " ".join(
+            "%s=\"%s\"" % (k, v.replace("&", "&amp;").replace("\"", "&quot;"))
+            for k, v in self.header["namespaces"].items())
+        self.wrapper = ("<w %s>" % self.namespace_decls).encode("utf-8")
+
+    def offsets(self, n):
+        if not 0 <= n < self.count: return 0, 0
+        start = self.table_start + 16 * n
+        return (int.from_bytes(self.idx[start:start + 8], "little"),
+                int.from_bytes(self.idx[start + 8:start + 16], "little"))
+
+    def numbers(self):
+        """Yields the numbers of the bsps in the file."""
+        for n in range(self.count):
+            if self.offsets(n)[1]: yield n
+
+    def __contains__(self, n):
+        return self.offsets(n)[1] != 0
+
+    def raw(self, n):
+        """Returns the bytes of the div for bsp number n."""
+        start, end = self.offsets(n)
+        if not end: raise KeyError("bsp" + str(n))
+        return self.mm[start:end]
+
+    def element(self, n):
+        """Returns the div for bsp number n as an element."""
+        return ET.fromstring(self.wrapper + self.raw(n) + b"</w>")[0]
+
+    def elements(self, numbers):
+        """Yields (n, div) for each of numbers, div being None if there is
+        no bsp n. Runs of bsps whose divs are in order in the file are
+        parsed together."""
+        run = []
+        for n in numbers:
+            if n in self:
+                run.append(n)
+            else:
+                yield from self.parse_run(run)
+                run = []
+                yield n, None
+        yield from self.parse_run(run)
+
+    def parse_run(self, run):
+        if not run: return
+        start, end = self.offsets(run[0])[0], self.offsets(run[-1])[1]
+        if start < end:
+            divs = ET.fromstring(self.wrapper + self.mm[start:end] + b"</w>")
+            if (len(divs) == len(run) and
+                all(X.get("id") == "bsp" + str(n) for n, X in zip(run, divs))):
+                yield from zip(run, divs)
+                return
+        for n in run: yield n, self.element(n)
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+        self.idx.close()
+        self.idx_f.close()
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description=("Index a bsps file, so that single bsps can be fetched from it without "
+                     "reading the whole file, and print the given bsps."))
+    parser.add_argument("-b", "--bsps", default="bsps.xhtml",
+                        help="Name of 'bog standard paragraphs' file (default: 'bsps.xhtml')")
+    parser.add_argument("ids", nargs="*", help="Ids of bsps to print, e.g. bsp12")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    bsps = BspFile(args["bsps"])
+    if not args["ids"]:
+        print("%s bsps indexed in %s" % (sum(1 for X in bsps.numbers()),
+                                        index_filename(args["bsps"])))
+    for ident in args["ids"]:
+        m = re_bsp_id.match(ident)
+        if m and int(m.group(1)) in bsps:
+            sys.stdout.buffer.write(bsps.raw(int(m.group(1))) + b"\n")
+        else:
+            print("No such bsp:", ident)
+    bsps.close()
+
+
+if __name__ == "__main__": main()
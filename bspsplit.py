@@ -5,10 +5,12 @@ import subprocess
 import xml.etree.ElementTree as ET
 import argparse
 import collections
-import copy
 import os
 import shutil
+import urllib.parse
 import common
+import bspindex
+import docserver
 
 
 bsp_template = """\
@@ -27,107 +29,148 @@ skeleton_headers = """\
 <skel-headers xmlns="http://www.w3.org/1999/xhtml">
 
 <link rel="stylesheet" type="text/css" href="include/skel_styles.css"/>
-<script src="include/jquery-1.10.2.min.js" type="text/javascript"/>
 <script src="include/script.js" type="text/javascript" />
 </skel-headers>
 """
 
 
-def make_bog_standard_para_p(args, fail_list):
-    allowable_para_classes = []
-    if args["class"]:
-        allowable_para_classes = args["class"]
-    allowable_tags = ["{http://www.w3.org/1999/xhtml}i",
+def bsp_rules(args):
+    """Returns the sets of allowable paragraph classes, subelement tags and
+    span classes given by the command line arguments."""
+    allowable_para_classes = set(args["class"] or [])
+    allowable_tags = {"{http://www.w3.org/1999/xhtml}i",
                       "{http://www.w3.org/1999/xhtml}em",
                       "{http://www.w3.org/1999/xhtml}b",
-                      "{http://www.w3.org/1999/xhtml}strong"]
-    if args["tag"]:
-        allowable_tags.extend(["{http://www.w3.org/1999/xhtml}" + X for X in args["tag"]])
-    allowable_span_classes = [None, "smcap"]
-    if args["span_class"]:
-        allowable_span_classes.extend(args["span_class"])
-    def empty_p(e):
-        if not e.find(".//{http://www.w3.org/1999/xhtml}br") is None: return False
-        if e.text and len(e.text.replace(" ", "x").strip()): return False
-        for se in e:
-            if se.tail and len(se.tail.replace(" ", "x").strip()): return False
-            if empty_p(se) == False: return False
-        return True
-    def bog_standard_para_p(e):
-        if e.tag != "{http://www.w3.org/1999/xhtml}p":
-            fail_list.append((e, "not_para"))
-            return False
+                      "{http://www.w3.org/1999/xhtml}strong"}
+    allowable_tags.update("{http://www.w3.org/1999/xhtml}" + X for X in args["tag"] or [])
+    allowable_span_classes = {None, "smcap"}
+    allowable_span_classes.update(args["span_class"] or [])
+    return allowable_para_classes, allowable_tags, allowable_span_classes
+
+
+def has_text(s):
+    #True unless s is empty or only whitespace, non-breaking spaces counting as text
+    return bool(s) and ("\u00a0" in s or not s.isspace())
+
+
+def survey_paras(r, allowable_tags, allowable_span_classes):
+    """Walks r once, summarising each p element bottom-up. Returns a list
+    of the form [(p, parent, index, has_content, has_br, first_disallowed,
+    end), ..] in document order, where index is the position of p in
+    parent, has_content is True if any text within p (excluding its tail)
+    is more than whitespace, has_br is True if p contains a br element,
+    first_disallowed is the first element within p that is not allowed in
+    a BSP (or None) and end is the position in the list just past the
+    last p nested within p."""
+    paras = []
+    def survey(e):
+        #returns (has_content, has_br, first_disallowed) for the contents of e
+        content, br, disallowed = has_text(e.text), False, None
+        for c, se in enumerate(e):
+            tag = se.tag
+            if tag == "{http://www.w3.org/1999/xhtml}p":
+                p = len(paras)
+                paras.append(None)
+                sc, sb, sd = survey(se)
+                paras[p] = (se, e, c, sc, sb, sd, len(paras))
+            elif len(se):
+                sc, sb, sd = survey(se)
+            else:
+                #leaf, so only its text can matter
+                sc, sb, sd = content or has_text(se.text), False, None
+            if not content: content = sc or has_text(se.tail)
+            if sb or tag == "{http://www.w3.org/1999/xhtml}br": br = True
+            if disallowed is None:
+                if (tag in allowable_tags or
+                    (tag == "{http://www.w3.org/1999/xhtml}span" and
+                     se.get("class") in allowable_span_classes)):
+                    disallowed = sd
+                else:
+                    disallowed = se
+        return content, br, disallowed
+    survey(r)
+    return paras
+
+
+def process_bsps(r, rules, fail_list, start=0):
+    """Replaces each bog standard paragraph in r with a placeholder,
+    returning the list of paragraphs removed and a map of each p element
+    that remains to its parent. Paragraphs that are not BSPs are added to
+    fail_list with the reason they failed. rules are as returned by
+    bsp_rules. Placeholders are numbered from start."""
+    allowable_para_classes, allowable_tags, allowable_span_classes = rules
+    paras = survey_paras(r, allowable_tags, allowable_span_classes)
+    bsp_elements, parents = [], {}
+    c = 0
+    while c < len(paras):
+        e, parent, index, content, br, disallowed, end = paras[c]
+        c += 1
         if e.get("class") and e.get("class") not in allowable_para_classes:
             fail_list.append((e, "class"))
-            return False
-        if e.get("style"):
+        elif e.get("style"):
             fail_list.append((e, "style"))
-            return False
-        if empty_p(e):
+        elif not (content or br):
             fail_list.append((e, "empty"))
-            return False
-        for c in list(e):
-            for se in c.iter():
-                if (se.tag not in allowable_tags and not
-                    (se.tag == "{http://www.w3.org/1999/xhtml}span" and
-                     se.get("class") in allowable_span_classes)):
-                    fail_list.append((se, "subelement"))
-                    return False
-        return True
-    return bog_standard_para_p
-
-
-def process_bsps(r, bog_standard_para_p):
-    bsp_elements = []
-    for e in r.findall(".//{http://www.w3.org/1999/xhtml}p"):
-        if bog_standard_para_p(e):
-            e_copy = copy.deepcopy(e)
-            bsp_elements.append(e_copy)
-            ref = "bsp" + str(len(bsp_elements) - 1)
-            e.clear()
-            e.tag = "{http://www.w3.org/1999/xhtml}div"
-            e.attrib = {"id": ref, "class": "bsp_ph"}
-            e.tail = e_copy.tail
-    return bsp_elements
-
-
-def collapse_placeholders(r):
-    count = 0
-    def collapse(e, ph):
-        nonlocal count
-        if len(ph) == 0: return
-        count += 1
-        if len(ph) > 1:
-            ph[0].text = ph[0].get("id") + "…" + ph[-1].get("id")
+        elif disallowed is not None:
+            fail_list.append((disallowed, "subelement"))
         else:
-            ph[0].text = ph[0].get("id")
-        ph[0].attrib["class"] = "bsp_block"
-        del ph[0].attrib["id"]
-        for p in ph[1:]: e.remove(p)
+            #move the paragraph out, along with any p elements nested in it
+            ref = "bsp" + str(start + len(bsp_elements))
+            bsp_elements.append(e)
+            ph = ET.Element("{http://www.w3.org/1999/xhtml}div", {"id": ref, "class": "bsp_ph"})
+            ph.tail = e.tail
+            parent[index] = ph
+            c = end
+            continue
+        parents[e] = parent
+    return bsp_elements, parents
+
+
+def collapse(ph, href):
+    """Collapses a run of placeholders into the first of them, which
+    becomes a bsp_block marker holding a link to the bsps. href gives the
+    link target for the id of the first bsp. Returns the ids of the first
+    and last bsps."""
+    first, last = ph[0].get("id"), ph[-1].get("id")
+    a = ET.Element("{http://www.w3.org/1999/xhtml}a", {"class": "bsp_link", "href": href(first)})
+    a.text = first + "…" + last if len(ph) > 1 else first
+    ph[0].text = None
+    ph[0].insert(0, a)
+    ph[0].attrib["class"] = "bsp_block"
+    del ph[0].attrib["id"]
+    return first, last
+
+
+def collapse_placeholders(r, href):
+    """Collapses the runs of placeholders in r, returning a list of the
+    ids of the first and last bsps of each block."""
+    blocks = []
     def recursive_process(e):
-        ph = []
-        for se in list(e):
+        #runs of placeholders are collapsed into their first member, the
+        #children of e being rebuilt once rather than removed one by one
+        ph, kept, removed = [], [], False
+        for se in e:
             if se.get("class") == "bsp_ph":
+                if ph: removed = True
+                else: kept.append(se)
                 ph.append(se)
             else:
-                collapse(e, ph)
+                if ph: blocks.append(collapse(ph, href))
                 ph = []
+                kept.append(se)
                 recursive_process(se)
-        collapse(e, ph)
+        if ph: blocks.append(collapse(ph, href))
+        if removed: e[:] = kept
     recursive_process(r)
-    return count
+    return blocks
 
 
-def remove_subelements(e, e_list):
-    parents = {}
-    def recursive_map_parents(e):
-        for se in e:
-            parents[se] = e
-            recursive_map_parents(se)
-    recursive_map_parents(e)
+def remove_subelements(parents, e_list):
+    removals = collections.defaultdict(set)
     for el in e_list:
-        # print("Removing:", ET.tostring(el, encoding="unicode"))
-        parents[el].remove(el)
+        removals[parents[el]].add(el)
+    for parent, els in removals.items():
+        parent[:] = [X for X in parent if X not in els]
 
 
 def backup_file(f):
@@ -139,7 +182,7 @@ def backup_file(f):
     shutil.copyfile(f, bf)
 
 
-def parse_command_line():
+def parse_command_line(argv=None):
     #parse arguments
     parser = argparse.ArgumentParser(description="""\
 Seperate "bog standard paragraphs" to expose HTML skeleton.""")
@@ -157,13 +200,71 @@ Seperate "bog standard paragraphs" to expose HTML skeleton.""")
                         help="XML Input file")
     parser.add_argument("-e", "--strip_empty", action="store_true",
                         help="Strip out bsps with no content")
-    return vars(parser.parse_args())
+    parser.add_argument("-f", "--fragments", action="store_true",
+                        help=("Also write the bsps of each bsp block to a file of its own, in a "
+                              "directory named after the bsps file, for the skeleton to link to"))
+    parser.add_argument("--stream", action="store_true",
+                        help=("Stream the input file rather than loading it, so that memory use "
+                              "does not grow with the size of the book"))
+    return vars(parser.parse_args(argv))
 
 
-def main():
-    ET.register_namespace('', "http://www.w3.org/1999/xhtml")
-    args = parse_command_line()
-    root = common.parse_xhtml(args["input"])
+def fragments_dir(args):
+    return os.path.splitext(args["bsps"])[0] + "_fragments"
+
+
+def make_href(args):
+    """Returns a function giving the target of the link from the skeleton
+    to the bsps starting with a given id: the bsp in the bsps file, or
+    the fragment file for the block if fragments are being written."""
+    skel_dir = os.path.dirname(os.path.abspath(args["skeleton"]))
+    if args["fragments"]:
+        base = urllib.parse.quote(os.path.relpath(
+            os.path.abspath(fragments_dir(args)), skel_dir).replace(os.sep, "/"))
+        return lambda ident: "%s/%s.xhtml" % (base, ident)
+    base = urllib.parse.quote(os.path.relpath(
+        os.path.abspath(args["bsps"]), skel_dir).replace(os.sep, "/"))
+    return lambda ident: "%s#%s" % (base, ident)
+
+
+fragment_template = """\
+<?xml version="1.0" encoding="utf-8"?>
+<html %s>
+<head>
+<title>%s</title>
+</head>
+<body>
+"""
+
+
+def write_fragments(args, blocks):
+    """Writes the bsps of each block to a fragment file of its own, named
+    after the first bsp, copying them from the bsps file through its
+    index."""
+    frag_dir = fragments_dir(args)
+    os.makedirs(frag_dir, exist_ok=True)
+    for f in os.listdir(frag_dir):
+        if bspindex.re_bsp_id.match(os.path.splitext(f)[0]):
+            os.remove(os.path.join(frag_dir, f))
+    bsps = bspindex.BspFile(args["bsps"])
+    for first, last in blocks:
+        m, n = bspindex.re_bsp_id.match(first), bspindex.re_bsp_id.match(last)
+        if not (m and n): continue
+        start, end = bsps.offsets(int(m.group(1)))[0], bsps.offsets(int(n.group(1)))[1]
+        if start >= end: continue
+        title = first + "…" + last if first != last else first
+        with open(os.path.join(frag_dir, first + ".xhtml"), "wb") as f:
+            f.write((fragment_template % (bsps.namespace_decls, title)).encode("utf-8"))
+            f.write(bsps.mm[start:end])
+            f.write(b"\n</body>\n</html>\n")
+    bsps.close()
+
+
+def split_tree(root, args):
+    """Splits the tree root in memory, leaving the skeleton in root.
+    Returns the tree of bsps, the number of bsps, the list of bsp blocks
+    as returned by collapse_placeholders and the list of elements that
+    remain in the skeleton of the form [(element, reason), ..]."""
     head = root.find(".//{http://www.w3.org/1999/xhtml}head")
     body = root.find(".//{http://www.w3.org/1999/xhtml}body")
     #add skeleton headers
@@ -173,10 +274,7 @@ def main():
     head.extend(skel_headers)
     #split out bog standard paragraphs
     fail = []
-    bog_standard_para_p = make_bog_standard_para_p(args, fail)
-    bsp_el = process_bsps(body, bog_standard_para_p)
-    #write out modified xhtml
-    empty_elements = set()
+    bsp_el, parents = process_bsps(body, bsp_rules(args), fail)
     if args.get("strip_empty"):
         new_fail = []
         empty_list = []
@@ -186,29 +284,191 @@ def main():
             else:
                 new_fail.append(X)
         fail = new_fail
-        remove_subelements(body, empty_list)
-    c_count = collapse_placeholders(body)
+        remove_subelements(parents, empty_list)
+    blocks = collapse_placeholders(body, make_href(args))
+    #create bsps xhtml
+    bsp_root = ET.fromstring(bsp_template)
+    bsp_body = bsp_root.find("{http://www.w3.org/1999/xhtml}body")
+    for c, el in enumerate(bsp_el):
+        bsp_body.append(bsp_div(c, el))
+    return ET.ElementTree(bsp_root), len(bsp_el), blocks, fail
+
+
+def split(args, root=None):
+    """Splits the input file, returning the number of bsps extracted, the
+    number of bsp blocks and the list of elements that remain in the
+    skeleton of the form [(element, reason), ..]. If root is given it is
+    used in place of the input file, and becomes the skeleton."""
+    if root is None: root = common.parse_xhtml(args["input"])
+    bsp_tree, bsp_count, blocks, fail = split_tree(root, args)
     backup_file(args["skeleton"])
     root.write(args["skeleton"],
                encoding="unicode",
                xml_declaration=True)
-    #create and write out bsps xhtml
+    backup_file(args["bsps"])
+    bsp_tree.write(args["bsps"],
+                   encoding="unicode",
+                   xml_declaration=True)
+    bspindex.write_index(args["bsps"])
+    if args["fragments"]: write_fragments(args, blocks)
+    return bsp_count, len(blocks), fail
+
+
+def bsp_div(c, el):
+    bsp = ET.Element("{http://www.w3.org/1999/xhtml}div",
+                     {"id": "bsp" + str(c)})
+    bsp.text = "bsp" + str(c)
+    bsp.append(el)
+    bsp.tail = "\n"
+    return bsp
+
+
+def stream_split(args):
+    """As split, but the input file is streamed rather than loaded. Each p
+    in the body is classified as it closes, each BSP is written out as soon
+    as it is complete and runs of placeholders are collapsed as they end,
+    so only the open elements and the outermost p being read are held in
+    memory. The output is the same as that of split. Returns the number
+    of bsps, the number of bsp blocks and a Counter of the report entries
+    for the elements that remain in the skeleton."""
+    rules = bsp_rules(args)
+    skel, bsps = common.StreamWriter(), common.StreamWriter()
     bsp_root = ET.fromstring(bsp_template)
     bsp_body = bsp_root.find("{http://www.w3.org/1999/xhtml}body")
-    for c, el in enumerate(bsp_el):
-        bsp = ET.Element("{http://www.w3.org/1999/xhtml}div",
-                         {"id": "bsp" + str(c)})
-        bsp.text = "bsp" + str(c)
-        bsp.append(el)
-        bsp.tail = "\n"
-        bsp_body.append(bsp)
+    bsps.start(bsp_root, bsp_root.text)
+    bsps.element(bsp_root.find("{http://www.w3.org/1999/xhtml}head"))
+    skel_headers = [se for se in ET.XML(skeleton_headers)]
+    fail, fail_count = [], collections.Counter()
+    bsp_count = 0
+    href, blocks = make_href(args), []
+    head = body = unit = None
+    in_body = False
+    #each open element of the skeleton has a frame of the form [element,
+    #start tag written, pending, run]. pending is the last subelement
+    #closed, whose tail is not known until the next one starts, of the form
+    #(kind, element, placeholder). run is the run of placeholders being
+    #collapsed, of the form [first] or [first, last].
+    stack = []
+    def start_tags(frames):
+        for frame in frames:
+            if not frame[1]:
+                skel.start(frame[0], frame[0].text)
+                frame[1] = True
+    def write_bsp(el):
+        nonlocal bsp_count
+        if not bsp_count: bsps.start(bsp_body, bsp_body.text)
+        bsps.element(bsp_div(bsp_count, el))
+        bsp_count += 1
+    def close_run(frame):
+        if frame[3] is None: return
+        blocks.append(collapse(frame[3], href))
+        start_tags(stack)
+        skel.element(frame[3][0])
+        frame[3] = None
+    def add_to_run(frame, ph):
+        if frame[3] is None: frame[3] = [ph]
+        else: frame[3][1:] = [ph]
+    def finish_pending(frame):
+        if frame[2] is None: return
+        kind, el, ph = frame[2]
+        frame[2] = None
+        if kind == "streamed":
+            skel.text(el.tail)
+        elif kind == "bsp":
+            ph.tail = el.tail
+            write_bsp(el)
+            add_to_run(frame, ph)
+        elif kind == "ph":
+            add_to_run(frame, el)
+        elif kind == "skeleton":
+            close_run(frame)
+            start_tags(stack)
+            skel.element(el)
+        frame[0].remove(el)
+    def finish_unit(el):
+        #runs the in-memory processing over a p (or placeholder) and the
+        #elements within it
+        w = ET.Element("w")
+        w.append(el)
+        bsp_el, parents = process_bsps(w, rules, fail, bsp_count)
+        if args["strip_empty"]:
+            remove_subelements(parents, [X[0] for X in fail if X[1] == "empty"])
+            fail[:] = [X for X in fail if X[1] != "empty"]
+        if not len(w):
+            result = "removed", el, None
+        elif w[0] is not el:
+            result = "bsp", el, w[0]
+        else:
+            for X in bsp_el: write_bsp(X)
+            if el.get("class") == "bsp_ph":
+                result = "ph", el, None
+            else:
+                blocks.extend(collapse_placeholders(el, href))
+                result = "skeleton", el, None
+        fail_count.update(fail_keys(fail))
+        del fail[:]
+        return result
+    for event, el in common.iterparse_xhtml(args["input"], ("start", "end")):
+        if unit is not None:
+            if event == "end" and el is unit:
+                stack[-1][2] = finish_unit(el)
+                unit = None
+        elif event == "start":
+            if stack:
+                finish_pending(stack[-1])
+                if in_body and (el.tag == "{http://www.w3.org/1999/xhtml}p" or
+                                el.get("class") == "bsp_ph"):
+                    unit = el
+                    continue
+                close_run(stack[-1])
+            stack.append([el, False, None, None])
+            if head is None and el.tag == "{http://www.w3.org/1999/xhtml}head":
+                head = el
+            if body is None and el.tag == "{http://www.w3.org/1999/xhtml}body":
+                body, in_body = el, True
+        else:
+            frame = stack[-1]
+            if el is head and frame[2]:
+                #add skeleton headers
+                skel_headers[-1].tail = frame[2][1].tail
+                frame[2][1].tail = "\n\n"
+                for X in skel_headers:
+                    finish_pending(frame)
+                    el.append(X)
+                    frame[2] = ("skeleton", X, None)
+            finish_pending(frame)
+            close_run(frame)
+            stack.pop()
+            if frame[1]:
+                skel.end(el)
+            else:
+                start_tags(stack)
+                if el.text:
+                    skel.start(el, el.text)
+                    skel.end(el)
+                else:
+                    skel.empty(el)
+            if el is body: in_body = False
+            if stack: stack[-1][2] = ("streamed", el, None)
+    if bsp_count: bsps.end(bsp_body)
+    else: bsps.empty(bsp_body)
+    bsps.text(bsp_body.tail)
+    bsps.end(bsp_root)
+    backup_file(args["skeleton"])
+    skel.close(args["skeleton"])
     backup_file(args["bsps"])
-    ET.ElementTree(bsp_root).write(args["bsps"],
-                                   encoding="unicode",
-                                   xml_declaration=True)
-    #report
-    print("Extracted %s bsps into %s bsp blocks" % (len(bsp_el), c_count))
-    e = collections.Counter([(X[0].tag, X[0].get("class", ""), X[0].get("style", ""), X[1]) for X in fail])
+    bsps.close(args["bsps"])
+    bspindex.write_index(args["bsps"])
+    if args["fragments"]: write_fragments(args, blocks)
+    return bsp_count, len(blocks), fail_count
+
+
+def fail_keys(fail):
+    return [(X[0].tag, X[0].get("class", ""), X[0].get("style", ""), X[1]) for X in fail]
+
+
+def report(bsp_count, c_count, e):
+    print("Extracted %s bsps into %s bsp blocks" % (bsp_count, c_count))
     print("The following remain in the skeleton:")
     for p, n in e.most_common():
         s = p[0].replace("{http://www.w3.org/1999/xhtml}", "")
@@ -218,7 +478,15 @@ def main():
         print(" ", n, ":", s)
 
 
-
+def main():
+    ET.register_namespace('', "http://www.w3.org/1999/xhtml")
+    args = parse_command_line()
+    if args["stream"]:
+        report(*stream_split(args))
+    elif not docserver.run("bspsplit", dict(args, **{
+            X: os.path.abspath(args[X]) for X in ("input", "skeleton", "bsps")})):
+        bsp_count, c_count, fail = split(args)
+        report(bsp_count, c_count, collections.Counter(fail_keys(fail)))
 
 
 if __name__ == "__main__":
@@ -1,8 +1,11 @@
 #!/usr/bin/python3
 
 import os
+import re
 import shutil
-import html
+import tempfile
+import collections
+import html.entities
 import xml.etree.ElementTree as et
 
 def backup_file(f):
@@ -14,16 +17,300 @@ def backup_file(f):
     shutil.copyfile(f, bf)
 
 
+#named entities mapped to their characters, other than those that XML itself defines
+entity_table = {k: v for k, v in html.entities.entitydefs.items()
+                if k not in ("quot", "amp", "apos", "lt", "gt")}
+re_entity = re.compile(r"&(#[0-9]+|#[xX][0-9a-fA-F]+|\w+);")
+max_entity_len = 40
+
+
+def entity_char(m):
+    ref = m.group(1)
+    if ref[0] != "#":
+        return entity_table.get(ref, m.group(0))
+    try:
+        c = int(ref[2:], 16) if ref[1] in "xX" else int(ref[1:])
+        ch = chr(c)
+    except (ValueError, OverflowError):
+        return m.group(0)
+    #leave references to characters that are special or not allowed in XML for the
+    #parser to deal with
+    if ch in "&<>\"'" or (c < 0x20 and ch not in "\t\n\r") or 0xd800 <= c <= 0xdfff:
+        return m.group(0)
+    return ch
+
+
 def fix_entities(text):
-    repl = html.entities.entitydefs
-    for e in ["quot", "amp", "apos", "lt", "gt"]:
-        if e in repl: del repl[e]
-    for e in repl:
-        text = text.replace("&" + e + ";", repl[e])
-    return text
-
-
-def parse_xhtml(filename):
-    text = open(filename).read()
-    text = fix_entities(text)
-    return et.ElementTree(et.XML(text))
+    """Replace named and numeric character references with the characters they
+    represent, in a single pass over text. References to the characters that are
+    special in XML and unknown names are left unchanged."""
+    if text.find("&") == -1: return text
+    return re_entity.sub(entity_char, text)
+
+
+def iter_fix_entities(chunks):
+    """As fix_entities, but works over an iterable of chunks of text, yielding
+    fixed chunks. References split across chunks are handled."""
+    pending = ""
+    for chunk in chunks:
+        text = pending + chunk
+        pending = ""
+        i = text.rfind("&", max(len(text) - max_entity_len, 0))
+        if i != -1 and text.find(";", i) == -1:
+            text, pending = text[:i], text[i:]
+        yield fix_entities(text)
+    if pending: yield fix_entities(pending)
+
+
+def parse_xhtml(source):
+    """Parse an xhtml file, given as a filename or a text file object, with
+    conversion of named entities to utf-8 characters. The file is decoded and fed
+    to the parser in chunks."""
+    f = open(source, encoding="utf-8") if isinstance(source, str) else source
+    parser = et.XMLParser()
+    try:
+        for text in iter_fix_entities(iter(lambda: f.read(1 << 20), "")):
+            parser.feed(text)
+    finally:
+        if f is not source: f.close()
+    return et.ElementTree(parser.close())
+
+
+def iterparse_xhtml(source, events=("end",)):
+    """As parse_xhtml, but yields (event, element) pairs as the file is parsed,
+    in the manner of ElementTree.iterparse."""
+    f = open(source, encoding="utf-8") if isinstance(source, str) else source
+    parser = et.XMLPullParser(events)
+    try:
+        for text in iter_fix_entities(iter(lambda: f.read(1 << 16), "")):
+            parser.feed(text)
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+    finally:
+        if f is not source: f.close()
+
+
+def splice_removed(e):
+    """Replaces each element within e whose tag has been set to None with
+    its content, as happens when the tree is written and read back. Tools
+    working on the same tree in memory need this to see what they would
+    see in the file. Returns True if anything was replaced."""
+    children, changed, spliced = [], False, False
+    def add_text(s):
+        if not s: return
+        if children: children[-1].tail = (children[-1].tail or "") + s
+        else: e.text = (e.text or "") + s
+    for se in e:
+        if splice_removed(se): changed = True
+        if se.tag is None:
+            spliced = True
+            add_text(se.text)
+            children.extend(se)
+            add_text(se.tail)
+        else:
+            children.append(se)
+    if spliced: e[:] = children
+    return changed or spliced
+
+
+class DocIndex:
+    """An index of the elements of a tree by tag, by class token and by
+    style, with a map of each element to its parent, built in a single
+    traversal. Queries return elements in document order. Tools that
+    change tags, classes or styles or remove elements should do so through
+    the index so that it stays current."""
+
+    def __init__(self, root):
+        self.root = root
+        #each key maps to a dict used as an ordered set of elements
+        self.tags = collections.defaultdict(dict)
+        self.classes = collections.defaultdict(dict)
+        self.styles = collections.defaultdict(dict)
+        self.parents = {}
+        #document position of each element, for sorting query results
+        self.positions = {}
+        self.add(root)
+
+    def add(self, e, parent=None):
+        """Indexes e and its descendants. Elements added after the index
+        was built sort after the rest."""
+        if parent is not None: self.parents[e] = parent
+        for se in e.iter():
+            self.positions[se] = len(self.positions)
+            self.tags[se.tag][se] = None
+            for c in se.get("class", "").split():
+                self.classes[c][se] = None
+            style = se.get("style")
+            if style: self.styles[style][se] = None
+            for sse in se: self.parents[sse] = se
+
+    def discard(self, e):
+        #removes e alone from the index
+        self.tags[e.tag].pop(e, None)
+        for c in e.get("class", "").split():
+            self.classes[c].pop(e, None)
+        if e.get("style"): self.styles[e.get("style")].pop(e, None)
+        self.parents.pop(e, None)
+        self.positions.pop(e, None)
+
+    def elements(self, tag=None, cls=None, style=None):
+        """Returns the elements, in document order, that have all of the
+        given tag, class token and style. A tag with no namespace is taken
+        to be in the xhtml namespace."""
+        sets = []
+        if tag is not None:
+            if tag[:1] != "{": tag = "{http://www.w3.org/1999/xhtml}" + tag
+            sets.append(self.tags.get(tag, {}))
+        if cls is not None: sets.append(self.classes.get(cls, {}))
+        if style is not None: sets.append(self.styles.get(style, {}))
+        if not sets: sets.append(self.positions)
+        sets.sort(key=len)
+        #elements whose tag has been set to None have been removed
+        found = [X for X in sets[0] if X.tag is not None and all(X in Y for Y in sets[1:])]
+        found.sort(key=self.positions.__getitem__)
+        return found
+
+    def select(self, selector):
+        """Returns the elements matching a selector of the form 'tag',
+        'tag.class' or '.class', the class matching any one of the
+        element's class tokens."""
+        tag, _, cls = selector.partition(".")
+        return self.elements(tag or None, cls or None)
+
+    def set_tag(self, e, tag):
+        """Changes the tag of e. A tag of None removes e but not its
+        content, as ElementTree does when the tree is written, and takes it
+        out of the class and style indexes too. Giving a removed element a
+        tag again puts it back."""
+        removing, restoring = tag is None, e.tag is None
+        self.tags[e.tag].pop(e, None)
+        e.tag = tag
+        if tag is not None: self.tags[tag][e] = None
+        if removing == restoring: return
+        keys = [(self.classes, X) for X in e.get("class", "").split()]
+        if e.get("style"): keys.append((self.styles, e.get("style")))
+        for d, k in keys:
+            if removing: d[k].pop(e, None)
+            else: d[k][e] = None
+
+    def set(self, e, key, value):
+        """Sets attribute key of e, deleting it if value is None."""
+        if key == "class":
+            for c in e.get("class", "").split():
+                self.classes[c].pop(e, None)
+            for c in (value or "").split():
+                self.classes[c][e] = None
+        elif key == "style":
+            if e.get("style"): self.styles[e.get("style")].pop(e, None)
+            if value: self.styles[value][e] = None
+        if value is None:
+            e.attrib.pop(key, None)
+        else:
+            e.set(key, value)
+
+    def clear(self, e):
+        """Removes the content of e, keeping its tag, attributes and tail."""
+        for se in e.iter():
+            if se is not e: self.discard(se)
+        tail, attrib = e.tail, dict(e.attrib)
+        e.clear()
+        e.tail = tail
+        e.attrib.update(attrib)
+
+    def remove(self, e):
+        """Removes e and its content from the tree. Its tail is kept."""
+        parent = self.parents[e]
+        for se in e.iter(): self.discard(se)
+        if e.tail:
+            i = list(parent).index(e)
+            if i: parent[i - 1].tail = (parent[i - 1].tail or "") + e.tail
+            else: parent.text = (parent.text or "") + e.tail
+        parent.remove(e)
+
+
+class StreamWriter:
+    """Writes an xml file an element at a time, giving the same output as
+    ElementTree.write would for the whole tree. ElementTree declares all
+    the namespaces used on the root's start tag, so everything after it is
+    spooled and the file is put together by close, once the namespaces
+    are known."""
+
+    def __init__(self):
+        self.qnames, self.namespaces = {}, {}
+        self.root = None
+        self.spool = tempfile.SpooledTemporaryFile(1 << 24, "w+", encoding="utf-8",
+                                                   newline="")
+        #small writes are gathered up and passed to the spool in batches
+        self.parts = []
+        self.write = self.parts.append
+
+    def flush(self):
+        self.spool.write("".join(self.parts))
+        del self.parts[:]
+
+    def qname(self, qname):
+        #as add_qname in ElementTree's _namespaces, so prefixes are given out
+        #in the same order
+        if qname in self.qnames: return self.qnames[qname]
+        if qname[:1] == "{":
+            uri, tag = qname[1:].rsplit("}", 1)
+            prefix = self.namespaces.get(uri)
+            if prefix is None:
+                prefix = et._namespace_map.get(uri)
+                if prefix is None:
+                    prefix = "ns%d" % len(self.namespaces)
+                if prefix != "xml":
+                    self.namespaces[uri] = prefix
+            self.qnames[qname] = "%s:%s" % (prefix, tag) if prefix else tag
+        else:
+            self.qnames[qname] = qname
+        return self.qnames[qname]
+
+    def start_tag(self, e):
+        tag = self.qname(e.tag)
+        return tag, "".join(" %s=\"%s\"" % (self.qname(k), et._escape_attrib(v))
+                            for k, v in e.items())
+
+    def start(self, e, text):
+        """Writes the start tag of e followed by text. The root's start tag
+        is held back until close."""
+        tag, attrs = self.start_tag(e)
+        if self.root is None:
+            self.root = tag, attrs
+        else:
+            self.write("<" + tag + attrs + ">")
+        self.text(text)
+
+    def empty(self, e):
+        tag, attrs = self.start_tag(e)
+        self.write("<" + tag + attrs + " />")
+
+    def end(self, e):
+        self.write("</" + self.qnames[e.tag] + ">")
+
+    def text(self, text):
+        if text: self.write(et._escape_cdata(text))
+
+    def element(self, e):
+        """Writes e, its subelements and its tail."""
+        for se in e.iter():
+            self.qname(se.tag)
+            for k in se.keys(): self.qname(k)
+        et._serialize_xml(self.write, e, self.qnames, None, short_empty_elements=True)
+        if len(self.parts) > 10000: self.flush()
+
+    def close(self, filename):
+        with open(filename, "w", encoding="utf-8", errors="xmlcharrefreplace") as f:
+            f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            if self.root:
+                tag, attrs = self.root
+                f.write("<" + tag)
+                for uri, prefix in sorted(self.namespaces.items(), key=lambda x: x[1]):
+                    f.write(" xmlns%s=\"%s\"" % (":" + prefix if prefix else "",
+                                                  et._escape_attrib(uri)))
+                f.write(attrs + ">")
+            self.flush()
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, f)
+        self.spool.close()
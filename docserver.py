@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import json
+import socket
+import argparse
+
+#The server keeps documents parsed in memory between runs of the tools.
+#replace_tag.py, haines_poem.py, inventory.py and bspsplit.py send their
+#work to it when it is running rather than parsing and writing the file
+#themselves. Changed documents are written back to disk once they have
+#been left alone for the debounce interval, or when asked to with flush.
+#
+#Requests and replies are lines of JSON over a Unix socket. A request is
+#{"op": op, "args": args}. The server replies with any number of
+#{"print": text} and {"input": prompt} messages, the client answering
+#each prompt with {"answer": text}, and then with {"done": result} or
+#{"error": message}.
+
+
+class NotRunning(Exception):
+    pass
+
+
+class DocServerError(Exception):
+    pass
+
+
+def socket_path():
+    """Returns $EBOOK_DOCSERVER if it is set, or else a path in the user's
+    runtime directory or, failing that, in a private directory in /tmp."""
+    if os.environ.get("EBOOK_DOCSERVER"): return os.environ["EBOOK_DOCSERVER"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "ebook-docserver.sock")
+    return os.path.join(private_dir(), "docserver.sock")
+
+
+def private_dir():
+    return os.path.join("/tmp", "ebook-docserver-%d" % os.getuid())
+
+
+def connect():
+    path = socket_path()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise NotRunning
+    #anyone could have put a socket in a shared directory, and the server
+    #is given the user's files and answers
+    if st.st_uid != os.getuid():
+        raise DocServerError("%s is not owned by you" % path)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        s.close()
+        raise NotRunning
+    return s
+
+
+def call(op, args):
+    """Sends a request to the server, showing its output and asking the
+    user any questions it has, and returns the result. Raises NotRunning
+    if there is no server, in which case the caller should do the work
+    itself."""
+    s = connect()
+    with s, s.makefile("rwb") as f:
+        def send(m):
+            f.write(json.dumps(m).encode("utf-8") + b"\n")
+            f.flush()
+        send({"op": op, "args": args})
+        for line in f:
+            m = json.loads(line)
+            if "print" in m:
+                sys.stdout.write(m["print"])
+            elif "input" in m:
+                send({"answer": input(m["input"])})
+            elif "error" in m:
+                raise DocServerError(m["error"])
+            else:
+                return m.get("done")
+    raise DocServerError("connection to server lost")
+
+
+def run(op, args):
+    """As call, but returns False rather than raising NotRunning, and
+    exits on an error from the server."""
+    try:
+        call(op, args)
+    except NotRunning:
+        return False
+    except DocServerError as e:
+        print("Error:", e)
+        sys.exit(-1)
+    return True
+
+
+#everything below is only needed by the server itself, so is imported when
+#it starts rather than by every client
+def serve(args):
+    import time
+    import copy
+    import stat
+    import traceback
+    import contextlib
+    import collections
+    import socketserver
+    import xml.etree.ElementTree as ET
+    import common
+    import replace_tag
+    import haines_poem
+    import inventory
+    import bspsplit
+
+    def file_stat(filename):
+        st = os.stat(filename)
+        return st.st_mtime_ns, st.st_size
+
+    class Document:
+        def __init__(self, filename, tree=None):
+            self.filename = filename
+            if tree is None:
+                tree = common.parse_xhtml(filename)
+                print("Loaded", filename, file=sys.__stdout__, flush=True)
+            self.tree = tree
+            #built when first needed and kept until a tool changes the tree
+            #other than through it
+            self.doc_index = None
+            self.stat = file_stat(filename)
+            #time of the last change not yet written, None if there is none
+            self.changed = None
+
+        def index(self):
+            if self.doc_index is None:
+                self.doc_index = common.DocIndex(self.tree.getroot())
+            return self.doc_index
+
+        def change(self, indexed=False):
+            self.changed = time.monotonic()
+            if not indexed: self.doc_index = None
+
+        def stale(self):
+            try:
+                return file_stat(self.filename) != self.stat
+            except OSError:
+                return False
+
+        def write(self):
+            common.backup_file(self.filename)
+            self.tree.write(self.filename, encoding="unicode", xml_declaration=True)
+            self.stat = file_stat(self.filename)
+            self.changed = None
+            print("Wrote", self.filename, file=sys.__stdout__, flush=True)
+
+    class Output:
+        #stands in for stdout while a request is handled, passing what the
+        #tools print on to the client
+        def __init__(self, handler):
+            self.handler = handler
+
+        def write(self, s):
+            if s: self.handler.send({"print": s})
+            return len(s)
+
+        def flush(self):
+            pass
+
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, m):
+            self.wfile.write(json.dumps(m).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+        def ask(self, prompt):
+            self.send({"input": prompt})
+            return json.loads(self.rfile.readline())["answer"]
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                op = ops[request["op"]]
+                with contextlib.redirect_stdout(Output(self)):
+                    result = op(self.server, self, request["args"])
+                self.send({"done": result})
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            except BaseException as e:
+                if isinstance(e, KeyboardInterrupt): raise
+                traceback.print_exc()
+                try:
+                    self.send({"error": "%s: %s" % (type(e).__name__, e)})
+                except OSError:
+                    pass
+
+    class DocServer(socketserver.UnixStreamServer):
+        def __init__(self, path, debounce):
+            self.documents = {}
+            self.debounce = debounce
+            self.stopping = False
+            #wake up regularly to write out documents that have settled
+            self.timeout = min(debounce, 0.5) if debounce > 0 else None
+            super().__init__(path, Handler)
+
+        def document(self, filename):
+            doc = self.documents.get(filename)
+            if doc is None:
+                doc = self.documents[filename] = Document(filename)
+            elif doc.stale():
+                if doc.changed is None:
+                    doc = self.documents[filename] = Document(filename)
+                else:
+                    print("Warning: %s has changed on disk, but the server has changes to "
+                          "it that will be written over it" % filename)
+            return doc
+
+        def flush(self, filenames=None, force=True):
+            now = time.monotonic()
+            for filename in filenames or list(self.documents):
+                doc = self.documents.get(filename)
+                if doc and doc.changed is not None and (
+                        force or now - doc.changed >= self.debounce):
+                    doc.write()
+
+        def serve(self):
+            while not self.stopping:
+                self.handle_request()
+                if self.debounce > 0: self.flush(force=False)
+            self.flush()
+
+    def op_replace_tag(server, handler, args):
+        doc = server.document(args["input"])
+        #if the client goes away at a question, apply leaves the tree as it
+        #was and the document is not marked as changed
+        replace_tag.apply(doc.index(), [tuple(X) for X in args["rules"]],
+                          args["clear"], handler.ask)
+        #removed tags are spliced out so that the other tools see the tree
+        #as they would see the file
+        doc.change(indexed=not common.splice_removed(doc.tree.getroot()))
+
+    def op_haines_poem(server, handler, args):
+        doc = server.document(args["input"])
+        #fix_poems rewrites the tree in place, so if it fails part way the
+        #document is dropped to be loaded again from disk, where any earlier
+        #changes to it have been written first
+        server.flush([doc.filename])
+        try:
+            haines_poem.fix_poems(doc.tree.getroot())
+        except BaseException:
+            server.documents.pop(doc.filename, None)
+            raise
+        common.splice_removed(doc.tree.getroot())
+        doc.change()
+
+    def op_inventory(server, handler, args):
+        #only documents already held are counted here, as only they can
+        #differ from the files on disk
+        return {X: inventory.count_tree(server.document(X).tree.getroot())
+                for X in args["files"] if X in server.documents}
+
+    def op_bspsplit(server, handler, args):
+        doc = server.document(args["input"])
+        tree = ET.ElementTree(copy.deepcopy(doc.tree.getroot()))
+        bsp_count, c_count, fail = bspsplit.split(args, tree)
+        bspsplit.report(bsp_count, c_count, collections.Counter(bspsplit.fail_keys(fail)))
+        #the skeleton has just been written, and is likely to be worked on next
+        server.documents[args["skeleton"]] = Document(args["skeleton"], tree)
+        server.documents.pop(args["bsps"], None)
+
+    def op_flush(server, handler, args):
+        server.flush(args.get("files"))
+
+    def op_close(server, handler, args):
+        for filename in args.get("files") or list(server.documents):
+            server.flush([filename])
+            server.documents.pop(filename, None)
+
+    def op_status(server, handler, args):
+        return [{"file": X.filename, "unsaved": X.changed is not None}
+                for X in server.documents.values()]
+
+    def op_stop(server, handler, args):
+        server.stopping = True
+
+    ops = {"replace_tag": op_replace_tag, "haines_poem": op_haines_poem,
+           "inventory": op_inventory, "bspsplit": op_bspsplit, "flush": op_flush,
+           "close": op_close, "status": op_status, "stop": op_stop}
+
+    ET.register_namespace('', "http://www.w3.org/1999/xhtml")
+    path = socket_path()
+    if os.path.dirname(path) == private_dir():
+        try:
+            os.mkdir(private_dir(), 0o700)
+        except FileExistsError:
+            st = os.lstat(private_dir())
+            if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+                    stat.S_IMODE(st.st_mode) & 0o077):
+                print("%s is not a private directory of yours" % private_dir())
+                sys.exit(-1)
+    try:
+        connect().close()
+        print("Server already running on", path)
+        sys.exit(-1)
+    except NotRunning:
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode): os.remove(path)
+    except DocServerError as e:
+        print("Error:", e)
+        sys.exit(-1)
+    server = DocServer(path, args["debounce"])
+    os.chmod(path, 0o600)
+    print("Serving on", path, flush=True)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        server.flush()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description=("Keep xhtml files parsed in memory between runs of replace_tag.py, "
+                     "haines_poem.py, inventory.py and bspsplit.py, which use the server "
+                     "when it is running. The socket is given by $EBOOK_DOCSERVER, or is "
+                     "in $XDG_RUNTIME_DIR or else a private directory in /tmp."))
+    parser.add_argument("command", choices=("start", "flush", "close", "status", "stop"),
+                        help=("start the server, or have it write out changes (flush), write "
+                              "out changes and forget files (close), list the files it holds "
+                              "(status) or stop"))
+    parser.add_argument("files", nargs="*",
+                        help="Files for flush and close (default: all files)")
+    parser.add_argument("-d", "--debounce", type=float, default=2.0,
+                        help=("Seconds after the last change to a file before it is written "
+                              "out, 0 to only write on flush, close or stop (default: 2)"))
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    if args["command"] == "start":
+        serve(args)
+        return
+    try:
+        result = call(args["command"], {"files": [os.path.abspath(X) for X in args["files"]]})
+    except NotRunning:
+        print("Server is not running")
+        sys.exit(-1)
+    except DocServerError as e:
+        print("Error:", e)
+        sys.exit(-1)
+    if args["command"] == "status":
+        for d in result:
+            print(d["file"], "(unsaved changes)" if d["unsaved"] else "")
+
+
+if __name__ == "__main__": main()
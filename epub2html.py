@@ -2,35 +2,73 @@
 
 import sys
 import os
-import tempfile
+import argparse
+import multiprocessing
+import io
+import re
 import zipfile
+import posixpath
 import xml.etree.ElementTree as ET
 import shutil
+import tempfile
 import hashlib
-import html.entities
-import re
+import html
+import common
 
-def unzip_epub(epub, tmpdir):
-    """An epub is packaged as a zip file. This function extracts it
-    into the tmpdir directory."""
-    try:
-        with zipfile.ZipFile(epub) as z:
-            zipinfo = z.infolist()
-            for i in zipinfo:
-                z.extract(i, path=tmpdir.name)
-    except zipfile.BadZipfile:
-        print(epub, "is not an epub")
-    except FileNotFoundError:
-        print(epub, "is not a file")
 
+class EpubContainer:
+    """An epub is packaged as a zip file. This class serves the files
+    in it directly from the archive, reading each one only when it is
+    asked for. Files are referred to by their href relative to the
+    opf file."""
+
+    def __init__(self, epub):
+        self.zip = zipfile.ZipFile(epub)
+        tree = ET.parse(self.zip.open("META-INF/container.xml"))
+        rf = tree.find(".//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile")
+        self.opf = rf.attrib["full-path"]
+        self.base = posixpath.dirname(self.opf)
 
-def process_opf(opf_filename):
-    """Extracts data from the content.opf file found in
-    tmpdir. Returns a tuple consisting of (spine_list, copy_list)
+    def path(self, href):
+        return posixpath.normpath(posixpath.join(self.base, href))
+
+    def open(self, href):
+        """Returns a binary file object for href."""
+        return self.zip.open(self.path(href))
+
+    def read(self, href):
+        return self.zip.read(self.path(href))
+
+    def read_head(self, href):
+        """Returns the text of href up to the end of its head section,
+        reading no more of the file than necessary."""
+        data = b""
+        with self.open(href) as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                data += chunk
+                i = data.find(b"/head>", max(len(data) - len(chunk) - 5, 0))
+                if i != -1: return data[:i + 6].decode("utf-8")
+        return data.decode("utf-8")
+
+    def size(self, href):
+        return self.zip.getinfo(self.path(href)).file_size
+
+    def copy(self, href, filename):
+        """Streams href from the archive to filename."""
+        with self.open(href) as src, open(filename, "wb") as dest:
+            shutil.copyfileobj(src, dest)
+
+    def close(self):
+        self.zip.close()
+
+
+def process_opf(opf_file):
+    """Extracts data from the content.opf file, given as a filename or
+    file object. Returns a tuple consisting of (spine_list, copy_list)
     where spine_list is a list of the form [(idref, fullpath), ..] and
     copy_list is a simple list of relevant files that do not appear in
     the spine and thus will need copying."""
-    tree = ET.parse(opf_filename)
+    tree = ET.parse(opf_file)
     manifest = tree.find(".//{http://www.idpf.org/2007/opf}manifest")
     id_dict = {}
     filelist = set()
@@ -48,15 +86,14 @@ def process_opf(opf_filename):
     return retval, [id_dict[X] for X in filelist]
 
 
-def head_text_digest(filename):
-    """Creates a sha1 hash of the head section of an xhtml file. This
-    allows comparison of the heads on a purely text basis. Note that
-    files with exactly equivalent heads in terms of xhtml may not have
-    identical heads in terms of text."""
-    text = open(filename).read()
+def head_text_digest(text):
+    """Creates a sha1 hash of the head section of the text of an xhtml
+    file. This allows comparison of the heads on a purely text
+    basis. Note that files with exactly equivalent heads in terms of
+    xhtml may not have identical heads in terms of text."""
     head_start = text.find("<head")
     head_end = text.find("/head>")
-    h = ET.XML(fix_entities(text[head_start:head_end + 6]))
+    h = ET.XML(common.fix_entities(text[head_start:head_end + 6]))
     s = []
     for el in h:
         if el.tag == "title": continue
@@ -67,16 +104,55 @@ def head_text_digest(filename):
     return hashlib.sha1(str(s).encode()).digest()
 
 
-def group_spine(spine, input_dir):
+class SpineCache:
+    """Spine documents read from the epub. Each document is read from
+    the archive once: its head digest is computed from the data read
+    and the data is kept until output_group_file asks for the parsed
+    document. To bound memory, a document is only kept if the total
+    size of the kept documents stays within budget bytes; otherwise
+    only its head is read for the digest and the whole document is
+    read again when it is needed. The raw data rather than the parsed
+    tree is kept since holding many parsed trees makes the garbage
+    collector's passes expensive enough to cost more than parsing."""
+
+    default_budget = 64 * 1024 * 1024
+
+    def __init__(self, container, budget=default_budget):
+        self.container = container
+        self.budget = budget
+        self.used = 0
+        self.docs = {}
+
+    def digest(self, href):
+        size = self.container.size(href)
+        if self.used + size > self.budget:
+            return head_text_digest(self.container.read_head(href))
+        data = self.container.read(href)
+        self.docs[href] = data
+        self.used += size
+        head_end = data.find(b"/head>")
+        return head_text_digest(data[:head_end + 6].decode("utf-8"))
+
+    def get(self, href):
+        """Returns the parsed document for href, releasing it from the
+        cache."""
+        data = self.docs.pop(href, None)
+        if data is None:
+            return parse_xhtml(self.container.open(href))
+        self.used -= len(data)
+        return parse_xhtml(io.BytesIO(data))
+
+
+def group_spine(spine, cache):
     """Takes the spine list and reorganises it to group together xhtml
     files with identical head sections. The output is of the form
     [[(idref, filename), ..], ..] where all items in the second level
     lists have identical head sections."""
     current_group = [spine[0]]
     spine_groups = [current_group]
-    current_digest = head_text_digest(os.path.join(input_dir, spine[0][1]))
+    current_digest = cache.digest(spine[0][1])
     for s in spine[1:]:
-        digest = head_text_digest(os.path.join(input_dir, s[1]))
+        digest = cache.digest(s[1])
         if digest == current_digest:
             current_group.append(s)
         else:
@@ -86,78 +162,284 @@ def group_spine(spine, input_dir):
     return spine_groups
 
 
-def modify_ids(el, idref):
-    """Modify all the id attributes in el and its subelements by
-    prepending idref."""
-    for e in el.findall(".//*[@id]"):
-        ident = e.get("id")
-        e.set("id", idref + ident)
+def parse_xhtml(f):
+    """Parses an xhtml file from the epub, given as a binary file
+    object, with conversion of named entities to utf-8 characters"""
+    return common.parse_xhtml(
+        io.TextIOWrapper(f, encoding="utf-8")).getroot()
 
 
-def modify_links(el, prefix_map):
-    """Modify all internal links found in el's subelements using prefix
-    map. The prefix map maps a filename to the filename of the joined
-    file plus the idref of the original file."""
-    for e in el.findall(".//{http://www.w3.org/1999/xhtml}a"):
+def fix_spine_item(root, idref, prefix_map):
+    """Places a new anchor with the id equal to idref at the start of
+    the body of the parsed spine item root. Then, in a single pass over
+    the body, modifies all its id attributes by prepending idref and
+    modifies its internal links using prefix map. The prefix map maps a
+    filename to the filename of the joined file plus the idref of the
+    original file. Returns (root, ids, links), where ids is a list of
+    the new ids and links is a list of the internal links that can be
+    checked against them, as written."""
+    body = root.find(".//{http://www.w3.org/1999/xhtml}body")
+    body.insert(0, ET.Element("{http://www.w3.org/1999/xhtml}a",
+                              {"id": "", "class": "epub_break"}))
+    ids, links = [], []
+    elements = body.iter()
+    next(elements)
+    for e in elements:
+        ident = e.get("id")
+        if ident is not None:
+            ident = idref + ident
+            e.set("id", ident)
+            ids.append(ident)
+        if e.tag != "{http://www.w3.org/1999/xhtml}a": continue
         href = e.get("href")
         if not href or href.startswith("http://") or href.startswith("https://"):
             continue
         parts = href.split("#")
         parts.append("")
-        if parts[0] in prefix_map.keys():
-            e.set("href", prefix_map[parts[0]] + parts[1])
+        if parts[0] in prefix_map:
+            href = prefix_map[parts[0]] + parts[1]
+            e.set("href", href)
+            links.append(href)
+        elif not parts[0]:
+            links.append(href)
+    return root, ids, links
+
+
+class IdIndex:
+    """Index of the ids in the output files, built up as the spine
+    items are fixed up, so that the internal links can be checked
+    without reading the output files again."""
+
+    def __init__(self, prefix_map):
+        self.prefix_map = prefix_map
+        self.ids = {}
+        self.duplicates = []
+        self.links = []
+
+    def add(self, href, ids, links):
+        """Adds the ids and links returned by fix_spine_item for the
+        spine item href."""
+        filename = self.prefix_map[os.path.basename(href)].split("#")[0]
+        file_ids = self.ids.setdefault(filename, {})
+        new_ids = dict.fromkeys(ids, href)
+        if len(new_ids) != len(ids) or not file_ids.keys().isdisjoint(new_ids):
+            seen = set()
+            for ident in ids:
+                if ident in seen or ident in file_ids:
+                    self.duplicates.append((filename, ident, file_ids.get(ident, href), href))
+                seen.add(ident)
+        file_ids.update((X, Y) for X, Y in new_ids.items() if X not in file_ids)
+        self.links.append((href, filename, links))
+
+    def dangling(self):
+        """Returns a list of the links whose target id does not exist,
+        of the form [(href, link), ..], where href is the spine item
+        containing the link."""
+        dangling = []
+        for href, filename, links in self.links:
+            for link in links:
+                target, fragment = link.split("#", 1)
+                if fragment not in self.ids.get(target or filename, ()):
+                    dangling.append((href, link))
+        return dangling
+
+
+#state of a worker process in a parallel run, set up by init_worker
+worker_container = None
+worker_prefix_map = None
+
+
+def init_worker(epub, prefix_map):
+    global worker_container, worker_prefix_map
+    ET.register_namespace("", "http://www.w3.org/1999/xhtml")
+    worker_container = EpubContainer(epub)
+    worker_prefix_map = prefix_map
 
 
-def fix_entities(text):
-    entities = set(re.findall(r"&(\w+);", text))
-    entities -= set(("quot", "amp", "apos", "lt", "gt"))
-    for e in entities:
-        text = text.replace("&" + e +";",
-                            chr(html.entities.name2codepoint[e]))
-    return text
+re_xmlns = re.compile(r' xmlns(?::([^=]+))?="([^"]*)"')
 
 
-def parse_xhtml(filename):
-    """Parses an xhtml file with conversion of named entities to utf-8 characters"""
-    text = open(filename, encoding="utf-8").read()
-    text = fix_entities(text)
-    return ET.XML(text)
+def namespace_order(elements):
+    """Returns the namespace uris used in the elements in the order in
+    which ElementTree first comes across them when serializing."""
+    uris = {}
+    for el in elements:
+        for e in el.iter():
+            for qname in [e.tag] + e.keys():
+                if isinstance(qname, str) and qname[:1] == "{":
+                    uris.setdefault(qname[1:].rsplit("}", 1)[0])
+    return list(uris)
 
 
-def output_group_file(spine_group, input_dir, output_dir, prefix_map):
+def serialize_body(body, with_text):
+    """Serializes the subelements of body, preceded by body's text if
+    with_text is set. The namespace prefixes used are those ElementTree
+    gives them when serializing the subelements as children of an
+    xhtml element, which may differ from those it will use for the
+    combined file. Returns (uris, text), where uris lists the namespaces
+    used in the order ElementTree first came across them, from which
+    the prefixes used can be worked out."""
+    w = ET.Element("{http://www.w3.org/1999/xhtml}w")
+    if with_text: w.text = body.text
+    w.extend(list(body))
+    text = ET.tostring(w, encoding="unicode")
+    start = text[:text.index(">") + 1]
+    if start.endswith("/>"): return [], ""
+    #the order of the namespaces with numbered prefixes is given by the numbers, but
+    #the order of any others with registered prefixes can only be found by looking
+    uris = ["http://www.w3.org/1999/xhtml"]
+    numbered = []
+    for prefix, uri in re_xmlns.findall(start):
+        uri = html.unescape(uri)
+        if re.match(r"ns[0-9]+$", prefix):
+            numbered.append((int(prefix[2:]), uri))
+        elif uri != uris[0]:
+            uris = None
+            break
+    if uris is None:
+        uris = namespace_order([w])
+    else:
+        uris.extend(X[1] for X in sorted(numbered))
+    return uris, text[len(start):-len("</w>")]
+
+
+def serialize_spine_item(root, first):
+    """Serializes the body of the fixed up spine item root as by
+    serialize_body. If the item is the first of its group, what
+    remains of the document is also returned, otherwise None is.
+    Returns (root, uris, text)."""
+    body = root.find(".//{http://www.w3.org/1999/xhtml}body")
+    uris, text = serialize_body(body, first)
+    if not first:
+        return None, uris, text
+    for e in list(body): body.remove(e)
+    body.text = None
+    return root, uris, text
+
+
+def read_spine(spine_groups, cache, index):
+    """Generates the results of serialize_spine_item for each of the
+    spine items in spine order, adding their ids and links to index.
+    Only one spine item is held as a parsed tree at a time."""
+    for sg in spine_groups:
+        for c, (idref, href) in enumerate(sg):
+            print("Reading", href)
+            root, ids, links = fix_spine_item(cache.get(href), idref, index.prefix_map)
+            index.add(href, ids, links)
+            yield serialize_spine_item(root, c == 0)
+
+
+def parse_spine_item(task):
+    """Parses, fixes up and serializes a spine item in a worker
+    process. Returns the result of serialize_spine_item along with the
+    ids and links of the item."""
+    idref, href, first = task
+    root, ids, links = fix_spine_item(parse_xhtml(worker_container.open(href)),
+                                      idref, worker_prefix_map)
+    return serialize_spine_item(root, first) + (ids, links)
+
+
+def read_spine_parallel(spine_groups, pool, index):
+    """As read_spine, but the spine items are parsed by the worker
+    processes of pool."""
+    tasks = [(s[0], s[1], c == 0) for sg in spine_groups for c, s in enumerate(sg)]
+    for (idref, href, first), result in zip(tasks, pool.imap(parse_spine_item, tasks)):
+        print("Reading", href)
+        root, uris, text, ids, links = result
+        index.add(href, ids, links)
+        yield root, uris, text
+
+
+def uri_prefixes(uris):
+    """Returns a map from namespace uri to the prefix ElementTree gives
+    the namespace when it comes across the namespaces in the order
+    given by uris."""
+    namespaces = {}
+    prefixes = {}
+    for uri in uris:
+        prefix = ET._namespace_map.get(uri)
+        if prefix is None:
+            prefix = "ns%d" % len(namespaces)
+        if prefix != "xml":
+            namespaces[uri] = prefix
+        prefixes[uri] = prefix
+    return prefixes
+
+
+def namespace_prefixes(root):
+    """Returns a map from namespace uri to the prefix ElementTree will
+    give the namespace when serializing root."""
+    return uri_prefixes(namespace_order([root]))
+
+
+re_tag = re.compile(r"<[^<>]*>")
+re_tag_name = re.compile(r'"[^"]*"|(?<=[</\s])([^\s"=/<>:]+):')
+
+
+def change_prefixes(text, renames):
+    """Changes the namespace prefixes of the element and attribute names
+    in the serialized xml text according to the map renames. Text
+    content and attribute values are left alone."""
+    def name(m):
+        if m.group(1) in renames:
+            return (renames[m.group(1)] + ":").lstrip(":")
+        return m.group(0)
+    return re_tag.sub(lambda m: re_tag_name.sub(name, m.group(0)), text)
+
+
+def output_group_file(spine_group, items, output_dir):
     """Takes a spine group and combines the sub-files into outputs a
     single file with the filename of the first file to the output_dir
-    directory. ids and links are fixed up, and a new anchor with the
-    id equal to the sub-file's idref is placed at the start of each
-    sub-file."""
-    print("Reading", spine_group[0][1])
-    first_file = parse_xhtml(os.path.join(input_dir, spine_group[0][1]))
-    body = first_file.find(".//{http://www.w3.org/1999/xhtml}body")
-    body.insert(0, ET.Element("{http://www.w3.org/1999/xhtml}a",
-                              {"id": "", "class": "epub_break"}))
-    modify_ids(body, spine_group[0][0])
-    modify_links(body, prefix_map)
-    for se in spine_group[1:]:
-        print("Reading", se[1])
-        next_file = parse_xhtml(os.path.join(input_dir, se[1]))
-        additional_body = next_file.find(".//{http://www.w3.org/1999/xhtml}body")
-        additional_body.insert(0, ET.Element(
-            "{http://www.w3.org/1999/xhtml}a",
-            {"id": "", "class": "epub_break"}))
-        modify_ids(additional_body, se[0])
-        modify_links(additional_body, prefix_map)
-        for e in additional_body:
-            body.append(e)
-    #output file
-    output_filename = os.path.join(output_dir, spine_group[0][1])
-    print("Writing", output_filename)
-    dest_directory = os.path.dirname(output_filename)
-    if dest_directory and not os.path.isdir(dest_directory):
-        os.makedirs(dest_directory)
-    ET.ElementTree(first_file).write(
-        output_filename,
-        encoding="unicode",
-        xml_declaration=True)
+    directory. The serialized sub-files are taken from the iterator
+    items, as generated by read_spine, and each is written out before
+    the next is taken. Returns the filename written.
+
+    The output is the same as ElementTree would write for the first
+    file with the bodies of the others appended to its body. The
+    namespace prefixes ElementTree would use are numbered in the order
+    in which it would first come across the namespaces, so the prefix
+    of a namespace first used in a body is known once the bodies
+    before it have been seen. Placeholder attributes on the body
+    element of the first file stand in for these namespaces, giving the
+    same numbering. The root element's namespace declarations are only
+    known once all the bodies have been seen though, so the bodies are
+    spooled until then."""
+    root, uris, text = next(items)
+    body = root.find(".//{http://www.w3.org/1999/xhtml}body")
+    placeholders = {}
+    prefixes = namespace_prefixes(root)
+    with tempfile.SpooledTemporaryFile(1 << 24, "w+", encoding="utf-8",
+                                       errors="xmlcharrefreplace") as spool:
+        for c in range(len(spine_group)):
+            if c: uris, text = next(items)[1:]
+            new_uris = [X for X in uris if X not in placeholders]
+            if new_uris:
+                for uri in new_uris:
+                    placeholders[uri] = None
+                    body.set("{%s}_" % uri, "")
+                prefixes = namespace_prefixes(root)
+            renames = {X: prefixes[Y] for Y, X in uri_prefixes(uris).items()
+                       if X != prefixes[Y]}
+            spool.write(change_prefixes(text, renames) if renames else text)
+            del text
+        body.text = "\x00"
+        f = io.StringIO()
+        ET.ElementTree(root).write(f, encoding="unicode", xml_declaration=True)
+        start, end = f.getvalue().split("\x00")
+        attribs = "".join(" %s=\"\"" % (prefixes[X] + ":_").lstrip(":") for X in placeholders)
+        start = start[:len(start) - len(attribs) - 1] + ">"
+        #output file
+        output_filename = os.path.join(output_dir, spine_group[0][1])
+        print("Writing", output_filename)
+        dest_directory = os.path.dirname(output_filename)
+        if dest_directory and not os.path.isdir(dest_directory):
+            os.makedirs(dest_directory)
+        spool.seek(0)
+        with open(output_filename, "w", encoding="utf-8", errors="xmlcharrefreplace") as f:
+            f.write(start)
+            shutil.copyfileobj(spool, f)
+            f.write(end)
+    return output_filename
 
 
 def prefix_map(spine_groups):
@@ -171,36 +453,77 @@ def prefix_map(spine_groups):
     return prefix_map
 
 
-def get_contents(dir_name):
-    tree = ET.parse(os.path.join(dir_name, "META-INF/container.xml"))
-    rf = tree.find(".//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile")
-    return rf.attrib["full-path"]
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description=("Convert an epub into a set of xhtml files, combining the spine "
+                     "items that share a head section. The files are written to the "
+                     "directory containing the epub."))
+    parser.add_argument("epub", help="Epub file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to use for parsing the spine items (default: 1)")
+    return vars(parser.parse_args())
+
+
+def convert(epub, output_dirname, jobs=1):
+    """Converts epub, writing the files to output_dirname. jobs is the
+    number of processes to use for parsing the spine items. Returns a
+    dictionary of statistics about the conversion."""
+    container = EpubContainer(epub)
+    try:
+        spine, copylist = process_opf(container.zip.open(container.opf))
+        #a parallel run only needs the heads in the main process
+        cache = SpineCache(container, 0 if jobs > 1 else SpineCache.default_budget)
+        spine_groups = group_spine(spine, cache)
+        #build output files
+        ET.register_namespace("", "http://www.w3.org/1999/xhtml")
+        pm = prefix_map(spine_groups)
+        index = IdIndex(pm)
+        written = []
+        if jobs > 1:
+            with multiprocessing.Pool(jobs, init_worker, (epub, pm)) as pool:
+                items = read_spine_parallel(spine_groups, pool, index)
+                for sg in spine_groups:
+                    written.append(output_group_file(sg, items, output_dirname))
+        else:
+            items = read_spine(spine_groups, cache, index)
+            for sg in spine_groups:
+                written.append(output_group_file(sg, items, output_dirname))
+        #copy other files
+        for f in copylist:
+            copy_filename = os.path.join(output_dirname, f)
+            dest_directory = os.path.dirname(copy_filename)
+            if dest_directory and not os.path.isdir(dest_directory):
+                os.makedirs(dest_directory)
+            print("Copying", copy_filename)
+            container.copy(f, copy_filename)
+            written.append(copy_filename)
+    finally:
+        container.close()
+    #report problems with ids and links
+    for filename, ident, first, href in index.duplicates:
+        print("Duplicate id %s in %s: from %s and %s" % (ident, filename, first, href))
+    dangling = index.dangling()
+    for href, link in dangling:
+        print("Dangling link in %s: %s" % (href, link))
+    return {"spine_items": len(spine),
+            "groups": len(spine_groups),
+            "files": len(written),
+            "bytes": sum(os.path.getsize(X) for X in written),
+            "duplicate_ids": len(index.duplicates),
+            "dangling_links": len(dangling)}
 
 
 def main():
-    if len(sys.argv) != 2 or sys.argv[1][0] == "-":
-        print("Usage:", sys.argv[0], "epubfile")
+    args = parse_command_line()
+    epub = args["epub"]
+    try:
+        convert(epub, os.path.dirname(epub), args["jobs"])
+    except zipfile.BadZipfile:
+        print(epub, "is not an epub")
+        sys.exit(-1)
+    except FileNotFoundError:
+        print(epub, "is not a file")
         sys.exit(-1)
-    epub = sys.argv[1]
-    tmpdir = tempfile.TemporaryDirectory()
-    unzip_epub(epub, tmpdir)
-    opf = os.path.join(tmpdir.name, get_contents(tmpdir.name))
-    spine, copylist = process_opf(opf)
-    spine_groups = group_spine(spine, os.path.dirname(opf))
-    #build output files
-    ET.register_namespace("", "http://www.w3.org/1999/xhtml")
-    output_dirname = os.path.dirname(epub)
-    pm = prefix_map(spine_groups)
-    for sg in spine_groups:
-        output_group_file(sg, os.path.dirname(opf), output_dirname, pm)
-    #copy other files
-    for f in copylist:
-        copy_filename = os.path.join(output_dirname, f)
-        dest_directory = os.path.dirname(copy_filename)
-        if dest_directory and not os.path.isdir(dest_directory):
-            os.makedirs(dest_directory)
-        print("Copying", copy_filename)
-        shutil.copy(os.path.join(os.path.dirname(opf), f), copy_filename)
 
 
 
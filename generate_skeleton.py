@@ -16,7 +16,6 @@ template = """\
   <link rel="stylesheet" type="text/css" href="gs_styles.css"/>
 
   <link href="include/skel_styles.css" rel="stylesheet" type="text/css" />
-  <script src="include/jquery-1.10.2.min.js" type="text/javascript" />
   <script src="include/script.js" type="text/javascript" />
 </head>
 <body>
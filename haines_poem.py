@@ -9,6 +9,7 @@ import copy
 import os
 import shutil
 import re
+import docserver
 
 
 def parse_command_line():
@@ -78,14 +79,20 @@ def group_stanzas(e):
 
 
 
-def main():
-    ET.register_namespace('', "http://www.w3.org/1999/xhtml")
-    args = parse_command_line()
-    root = ET.parse(args["input"])
+def fix_poems(root):
     body = root.find(".//{http://www.w3.org/1999/xhtml}body")
     for se in body.findall(".//{http://www.w3.org/1999/xhtml}p[@class='poem']"):
         replace_poem(se)
     group_stanzas(body)
+
+
+def main():
+    ET.register_namespace('', "http://www.w3.org/1999/xhtml")
+    args = parse_command_line()
+    if docserver.run("haines_poem", {"input": os.path.abspath(args["input"])}):
+        return
+    root = ET.parse(args["input"])
+    fix_poems(root.getroot())
     c, backup_filename = 0, args["input"] + ".old"
     while os.path.exists(backup_filename):
         c += 1
@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+
+import os
+import io
+import re
+import time
+import html
+import uuid
+import zlib
+import zipfile
+import posixpath
+import mimetypes
+import argparse
+import itertools
+import concurrent.futures
+import xml.etree.ElementTree as ET
+import common
+
+container_xml = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+opf_template = """\
+<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid" xml:lang="%s">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+%s
+  </metadata>
+  <manifest>
+%s
+  </manifest>
+  <spine>
+%s
+  </spine>
+</package>
+"""
+
+nav_template = """\
+<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head>
+  <title>%s</title>
+</head>
+<body>
+  <nav epub:type="toc" id="toc">
+    <h1>Contents</h1>
+    <ol>
+%s
+    </ol>
+  </nav>
+</body>
+</html>
+"""
+
+#media types that are already compressed, so are stored rather than deflated
+stored_types = {"image/jpeg", "image/png", "image/gif", "image/webp",
+                "font/woff", "font/woff2", "audio/mpeg", "video/mp4"}
+
+media_types = {".xhtml": "application/xhtml+xml", ".css": "text/css",
+               ".svg": "image/svg+xml", ".otf": "font/otf", ".ttf": "font/ttf",
+               ".woff": "font/woff", ".woff2": "font/woff2"}
+
+
+def media_type(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in media_types: return media_types[ext]
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def is_chapter(e):
+    return (e.tag == "{http://www.w3.org/1999/xhtml}div" and
+            "chapter" in e.get("class", "").split())
+
+
+def is_epub_break(e):
+    return (e.tag == "{http://www.w3.org/1999/xhtml}a" and
+            e.get("class") == "epub_break")
+
+
+def split_elements(parent, is_split):
+    """Splits the subelements of parent into parts, a new part being
+    started at each element for which is_split returns True. An element
+    that contains split points also starts a new part and is itself
+    split, each of the resulting parts getting a shallow copy of it
+    (without its id) to contain its share of its subelements. Returns a
+    list of parts of the form [[element, ..], ..]."""
+    parts = [[]]
+    for child in list(parent):
+        if is_split(child):
+            parts.append([child])
+        elif any(is_split(X) for X in child.iter()):
+            for c, elements in enumerate(split_elements(child, is_split)):
+                attrib = dict(child.attrib)
+                if c: attrib.pop("id", None)
+                container = ET.Element(child.tag, attrib)
+                if not c: container.text = child.text
+                container.extend(elements)
+                parts.append([container])
+            container.tail = child.tail
+        else:
+            parts[-1].append(child)
+    return [X for X in parts if X]
+
+
+def part_title(elements, default):
+    """Returns the text of the first heading in elements, or default."""
+    for el in elements:
+        for e in el.iter():
+            if e.tag in ("{http://www.w3.org/1999/xhtml}h1", "{http://www.w3.org/1999/xhtml}h2",
+                         "{http://www.w3.org/1999/xhtml}h3"):
+                text = " ".join("".join(e.itertext()).split())
+                if text: return text
+    return default
+
+
+def part_properties(elements):
+    """Returns the EPUB 3 manifest properties for a part containing
+    elements."""
+    properties = set()
+    for el in elements:
+        for e in el.iter():
+            if not isinstance(e.tag, str): continue
+            if e.tag.startswith("{http://www.w3.org/2000/svg}"):
+                properties.add("svg")
+            elif e.tag.startswith("{http://www.w3.org/1998/Math/MathML}"):
+                properties.add("mathml")
+            elif e.tag == "{http://www.w3.org/1999/xhtml}script":
+                properties.add("scripted")
+    return " ".join(sorted(properties))
+
+
+def fix_links(parts, filenames, source_name):
+    """Rewrites the internal links in parts so that they point into the
+    part files. Links that refer to an id with only a fragment or with
+    the name of the source file are rewritten."""
+    id_map = {}
+    for part, filename in zip(parts, filenames):
+        for el in part:
+            for e in el.iter():
+                ident = e.get("id")
+                if ident is not None: id_map[ident] = filename
+    for part, filename in zip(parts, filenames):
+        for el in part:
+            for e in el.iter("{http://www.w3.org/1999/xhtml}a"):
+                href = e.get("href")
+                if not href or "#" not in href: continue
+                target, fragment = href.split("#", 1)
+                if target not in ("", source_name) or fragment not in id_map:
+                    continue
+                if id_map[fragment] == filename:
+                    e.set("href", "#" + fragment)
+                else:
+                    e.set("href", id_map[fragment] + "#" + fragment)
+
+
+def find_resources(root):
+    """Returns the local files referenced by root as stylesheets, images
+    and the like, as relative paths."""
+    resources = []
+    for e in root.iter():
+        refs = [e.get("src"), e.get("{http://www.w3.org/1999/xlink}href")]
+        if e.tag == "{http://www.w3.org/1999/xhtml}link": refs.append(e.get("href"))
+        for ref in refs:
+            if not ref or re.match(r"[a-zA-Z][a-zA-Z0-9+.-]*:", ref): continue
+            ref = posixpath.normpath(ref.split("#")[0].split("?")[0])
+            if ref not in resources: resources.append(ref)
+    return resources
+
+
+def write_part(zf, arcname, html_el, head, body_attrib, elements):
+    """Streams a part file into the zip."""
+    root = ET.Element(html_el.tag, html_el.attrib)
+    root.text = "\n"
+    root.append(head)
+    body = ET.SubElement(root, "{http://www.w3.org/1999/xhtml}body", body_attrib)
+    body.text = "\n"
+    body.tail = "\n"
+    body.extend(elements)
+    zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    with zf.open(zinfo, "w") as raw:
+        f = io.TextIOWrapper(raw, encoding="utf-8", errors="xmlcharrefreplace")
+        f.write("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<!DOCTYPE html>\n")
+        ET.ElementTree(root).write(f, encoding="unicode")
+        f.flush()
+        f.detach()
+    root.remove(head)
+
+
+def deflate_file(filename):
+    """Compresses filename as raw deflate data, as zip files hold it.
+    Returns (data, crc)."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    chunks, crc = [], 0
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(chunk, crc)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return b"".join(chunks), crc
+
+
+#names in zipfile used by write_deflated that are not part of its interface
+zipfile_internals = ("fp", "start_dir", "_seekable", "_writing", "_lock", "_writecheck",
+                     "_didModify")
+
+
+def write_deflated(zf, filename, arcname, data, crc):
+    """Writes an entry whose data has already been compressed by
+    deflate_file. zipfile has no interface for this, so this, and only
+    this, uses its internals, doing what ZipFile.open(arcname, "w") and
+    closing the returned file do in CPython 3.6 to 3.12 for a seekable
+    file. Should they not be there, the file is compressed again through
+    ZipFile.write instead."""
+    if not (all(hasattr(zf, X) for X in zipfile_internals) and zf._seekable):
+        zf.write(filename, arcname)
+        return
+    zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    if zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT:
+        raise zipfile.LargeZipFile(arcname + " is too large")
+    with zf._lock:
+        if zf._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write "
+                             "handle open on it")
+        zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(False))
+        zf.fp.write(data)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[arcname] = zinfo
+
+
+def opf_text(metadata, manifest, spine):
+    """Builds the package document. manifest is a list of the form
+    [(id, href, media_type, properties), ..] and spine a list of ids."""
+    md = ["    <dc:identifier id=\"bookid\">%s</dc:identifier>" % html.escape(metadata["identifier"]),
+          "    <dc:title>%s</dc:title>" % html.escape(metadata["title"])]
+    if metadata["author"]:
+        md.append("    <dc:creator>%s</dc:creator>" % html.escape(metadata["author"]))
+    md.append("    <dc:language>%s</dc:language>" % html.escape(metadata["language"]))
+    md.append("    <meta property=\"dcterms:modified\">%s</meta>" % metadata["modified"])
+    items = []
+    for ident, href, mtype, properties in manifest:
+        items.append("    <item id=\"%s\" href=\"%s\" media-type=\"%s\"%s/>" % (
+            ident, html.escape(href), mtype,
+            " properties=\"%s\"" % properties if properties else ""))
+    itemrefs = ["    <itemref idref=\"%s\"/>" % X for X in spine]
+    return opf_template % (html.escape(metadata["language"]), "\n".join(md),
+                           "\n".join(items), "\n".join(itemrefs))
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description=("Package an xhtml file, such as the output of recombine.py, as an "
+                     "EPUB 3 file. Stylesheets and images referenced by the xhtml file "
+                     "are included."))
+    parser.add_argument("input", help="Input xhtml file")
+    parser.add_argument("-o", "--output",
+                        help="Output epub file (default: input file name with .epub extension)")
+    parser.add_argument("-r", "--resource", action="append", default=[],
+                        help=("Additional file to include, relative to the directory of the "
+                              "input file. May be given more than once."))
+    parser.add_argument("-s", "--split", choices=("chapter", "break", "none"), default="chapter",
+                        help=("Where to split the book into separate files: at div elements "
+                              "with class chapter, at the epub_break anchors left by "
+                              "epub2html.py, or not at all (default: chapter)"))
+    parser.add_argument("--identifier", help="Unique identifier (default: a random urn:uuid)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help=("Number of threads to use for compressing large resources "
+                              "(default: number of CPUs)"))
+    parser.add_argument("--threshold", type=int, default=1 << 18,
+                        help=("Resources of at least this many bytes are compressed in "
+                              "parallel (default: 262144)"))
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    ET.register_namespace("", "http://www.w3.org/1999/xhtml")
+    source = args["input"]
+    base_dir = os.path.dirname(source)
+    output = args["output"] or os.path.splitext(source)[0] + ".epub"
+    root = common.parse_xhtml(source).getroot()
+    head = root.find("{http://www.w3.org/1999/xhtml}head")
+    body = root.find("{http://www.w3.org/1999/xhtml}body")
+    title_el = head.find("{http://www.w3.org/1999/xhtml}title")
+    author_el = head.find("{http://www.w3.org/1999/xhtml}meta[@name='author']")
+    metadata = {
+        "title": title_el.text if title_el is not None and title_el.text else "Untitled",
+        "author": author_el.get("content") if author_el is not None else None,
+        "language": (root.get("{http://www.w3.org/XML/1998/namespace}lang") or
+                     root.get("lang") or "en"),
+        "identifier": args["identifier"] or "urn:uuid:" + str(uuid.uuid4()),
+        "modified": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    #split the body into parts
+    if args["split"] == "none":
+        parts = [list(body)]
+    else:
+        parts = split_elements(body, is_chapter if args["split"] == "chapter" else is_epub_break)
+    filenames = ["part%04d.xhtml" % (X + 1) for X in range(len(parts))]
+    fix_links(parts, filenames, os.path.basename(source))
+    #work out the resources
+    resources = []
+    for r in find_resources(root) + args["resource"]:
+        r = posixpath.normpath(r)
+        if r.startswith("../") or r.startswith("/"):
+            print("Skipping", r, "as it is outside the directory of the input file")
+        elif not os.path.isfile(os.path.join(base_dir, r)):
+            print("Skipping", r, "as it does not exist")
+        elif r not in resources:
+            resources.append(r)
+    manifest = [("nav", "nav.xhtml", "application/xhtml+xml", "nav")]
+    manifest += [("p%d" % (c + 1), X, "application/xhtml+xml", part_properties(parts[c]))
+                 for c, X in enumerate(filenames)]
+    manifest += [("r%d" % (c + 1), X, media_type(X), None) for c, X in enumerate(resources)]
+    spine = ["p%d" % (c + 1) for c in range(len(parts))]
+    large = [X for X in resources if media_type(X) not in stored_types and
+             os.path.getsize(os.path.join(base_dir, X)) >= args["threshold"]]
+    #the large resources start being compressed while the text is being
+    #written. No more than jobs are compressed ahead of being written, so
+    #that only that many compressed copies are held at once.
+    with concurrent.futures.ThreadPoolExecutor(args["jobs"]) as executor, \
+         zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+        deflated, todo = {}, iter(large)
+        def submit():
+            for r in itertools.islice(todo, max(args["jobs"], 1) - len(deflated)):
+                deflated[r] = executor.submit(deflate_file, os.path.join(base_dir, r))
+        submit()
+        zf.writestr(zipfile.ZipInfo("mimetype", time.localtime()[:6]), "application/epub+zip",
+                    compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", container_xml)
+        zf.writestr("OEBPS/content.opf", opf_text(metadata, manifest, spine))
+        toc = "\n".join("      <li><a href=\"%s\">%s</a></li>" % (
+            X, html.escape(part_title(Y, "Part %d" % (c + 1))))
+            for c, (X, Y) in enumerate(zip(filenames, parts)))
+        zf.writestr("OEBPS/nav.xhtml", nav_template % (html.escape(metadata["title"]), toc))
+        body_attrib = dict(body.attrib)
+        for filename, part in zip(filenames, parts):
+            print("Writing", filename)
+            write_part(zf, "OEBPS/" + filename, root, head, body_attrib, part)
+        for r in resources:
+            print("Adding", r)
+            filename = os.path.join(base_dir, r)
+            if r in deflated:
+                data, crc = deflated.pop(r).result()
+                submit()
+                write_deflated(zf, filename, "OEBPS/" + r, data, crc)
+            elif media_type(r) in stored_types:
+                zf.write(filename, "OEBPS/" + r, zipfile.ZIP_STORED)
+            else:
+                zf.write(filename, "OEBPS/" + r)
+    print("Written", output)
+
+
+if __name__ == "__main__": main()
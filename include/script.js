@@ -1,9 +1,34 @@
-$(function() {
-    $("div[class='bsp_block']").each(
-      function() {
-        var bspid = $(this).text().split("…")[0];
-        var text = $(this).text();
-        $(this).text("");
-        $(this).append("<a href='bsps.xhtml#" + bspid + "'>" + text + "</a>");
-      });
-});  
+//Links to fragment files are opened in place below their bsp block, a
+//second click hiding them again. Links into bsps.xhtml are followed as
+//normal. Old skeletons without links get them added as they are clicked.
+document.addEventListener("click", function(event) {
+    var block = event.target.closest("div.bsp_block");
+    if (!block) return;
+    var link = block.querySelector("a.bsp_link");
+    if (!link) {
+        location.href = "bsps.xhtml#" + block.textContent.split("…")[0];
+        return;
+    }
+    if (event.target !== link || link.getAttribute("href").indexOf("#") != -1) return;
+    event.preventDefault();
+    var next = block.nextElementSibling;
+    if (next && next.classList.contains("bsp_fragment")) {
+        next.hidden = !next.hidden;
+        return;
+    }
+    fetch(link.href)
+        .then(function(response) {
+            if (!response.ok) throw new Error(response.statusText);
+            return response.text();
+        })
+        .then(function(text) {
+            var doc = new DOMParser().parseFromString(text, "application/xhtml+xml");
+            var fragment = document.createElementNS("http://www.w3.org/1999/xhtml", "div");
+            fragment.className = "bsp_fragment";
+            Array.from(doc.body.childNodes).forEach(function(node) {
+                fragment.appendChild(document.importNode(node, true));
+            });
+            block.after(fragment);
+        })
+        .catch(function() {location.href = link.href;});
+});
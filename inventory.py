@@ -4,30 +4,210 @@ import sys
 import xml.etree.ElementTree as ET
 import argparse
 import collections
+import concurrent.futures
+import json
 import os
+import common
+import docserver
+
+
+#counts are cached by absolute path, so one cache serves every directory
+default_cache = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                             os.path.join(os.path.expanduser("~"), ".cache"),
+                             "ebook-tools", "inventory_cache.json")
 
 
 def parse_command_line():
     #parse arguments
     parser = argparse.ArgumentParser(description="""\
-Inventory an xhtml file.""")
-    parser.add_argument("input",
-                        help="XML Input file")
-    return vars(parser.parse_args())
+Inventory xhtml files, counting the tags (with their classes and styles) found as
+descendants of body.""")
+    parser.add_argument("input", nargs="*",
+                        help="XML Input files, or directories to search for .xhtml files")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of files to inventory at once (default: number of CPUs)")
+    parser.add_argument("-c", "--cache", default=default_cache,
+                        help=("File in which counts are cached for each input file, so that "
+                              "unchanged files are not read again (default: %s)" % default_cache))
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Neither read nor write the cache")
+    parser.add_argument("-o", "--json",
+                        help="Also write the inventory to this file as JSON ('-' for stdout)")
+    parser.add_argument("-l", "--load", action="append",
+                        help=("JSON inventory from a previous run to merge into this one "
+                              "(multiple allowed)"))
+    parser.add_argument("-d", "--diff",
+                        help="JSON inventory from a previous run to compare this one with")
+    args = vars(parser.parse_args())
+    if not args["input"] and not args["load"]:
+        parser.error("no input files or inventories to load")
+    return args
+
+
+def find_files(paths):
+    """Expands paths into a list of files. Directories are searched
+    recursively for files ending in .xhtml."""
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            for dirpath, dirnames, filenames in os.walk(p):
+                dirnames.sort()
+                files.extend(os.path.join(dirpath, X) for X in sorted(filenames)
+                             if X.lower().endswith(".xhtml"))
+        else:
+            files.append(p)
+    return files
+
+
+def inventory_file(filename):
+    """Counts the (tag, class, style) of each element in the body of an
+    xhtml file. The file is parsed as a stream and elements are thrown
+    away once they have been counted, so memory use does not grow with
+    the size of the file. Returns a list of [tag, class, style, count]."""
+    counts = collections.Counter()
+    stack, in_body = [], 0
+    for event, e in common.iterparse_xhtml(filename, ("start", "end")):
+        if event == "start":
+            if in_body or e.tag == "{http://www.w3.org/1999/xhtml}body":
+                in_body += 1
+                counts[(e.tag, e.get("class", ""), e.get("style", ""))] += 1
+            stack.append(e)
+        else:
+            stack.pop()
+            if in_body: in_body -= 1
+            e.clear()
+            #earlier siblings have already gone, so this is quick
+            if stack: stack[-1].remove(e)
+    return [list(k) + [n] for k, n in counts.items()]
+
+
+def count_tree(root):
+    """As inventory_file, but for a tree that has already been parsed."""
+    body = root.find(".//{http://www.w3.org/1999/xhtml}body")
+    #tags set to None have been removed, leaving their content
+    counts = collections.Counter((X.tag, X.get("class", ""), X.get("style", ""))
+                                 for X in body.iter() if X.tag is not None)
+    return [list(k) + [n] for k, n in counts.items()]
+
+
+def load_cache(filename):
+    try:
+        with open(filename, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def file_key(filename):
+    st = os.stat(filename)
+    return {"mtime": st.st_mtime_ns, "size": st.st_size}
+
+
+def inventory_files(files, jobs, cache):
+    """Returns a dict mapping each of files to its counts, and the number
+    of files found in cache. Files held by docserver.py are counted by
+    it, as they may have changes not yet written. Files whose path, mtime
+    and size match an entry in cache are not read again; cache is updated
+    with the rest."""
+    results, todo = {}, []
+    try:
+        held = docserver.call("inventory", {"files": [os.path.abspath(X) for X in files]})
+    except (docserver.NotRunning, docserver.DocServerError):
+        held = {}
+    for f in files:
+        path = os.path.abspath(f)
+        if path in held:
+            results[f] = held[path]
+            continue
+        try:
+            key = file_key(path)
+        except OSError as e:
+            print("Failed %s: %s" % (f, e), file=sys.stderr)
+            continue
+        entry = cache.get(path)
+        if entry and entry["mtime"] == key["mtime"] and entry["size"] == key["size"]:
+            results[f] = entry["counts"]
+        else:
+            todo.append((f, path, key))
+    def record(f, path, key, counts):
+        results[f] = counts
+        cache[path] = dict(key, counts=counts)
+    if jobs > 1 and len(todo) > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = {executor.submit(inventory_file, X[1]): X for X in todo}
+            for future in concurrent.futures.as_completed(futures):
+                f, path, key = futures[future]
+                try:
+                    record(f, path, key, future.result())
+                except Exception as e:
+                    print("Failed %s: %s: %s" % (f, type(e).__name__, e), file=sys.stderr)
+    else:
+        for f, path, key in todo:
+            try:
+                record(f, path, key, inventory_file(path))
+            except Exception as e:
+                print("Failed %s: %s: %s" % (f, type(e).__name__, e), file=sys.stderr)
+    return {f: results[f] for f in files if f in results}, len(files) - len(todo) - len(held)
+
+
+def total(inventories):
+    t = collections.Counter()
+    for counts in inventories:
+        for tag, cls, style, n in counts:
+            t[(tag, cls, style)] += n
+    return t
+
+
+def describe(p):
+    s = p[0].replace("{http://www.w3.org/1999/xhtml}", "")
+    if p[1]: s += " class=\"" + p[1] + "\""
+    if p[2]: s += " style=\"" + p[2] + "\""
+    return s
+
+
+def load_inventory(filename):
+    with open(filename, encoding="utf-8") as f:
+        return json.load(f)["files"]
 
 
 def main():
     ET.register_namespace('', "http://www.w3.org/1999/xhtml")
     args = parse_command_line()
-    root = ET.parse(args["input"])
-    body = root.find(".//{http://www.w3.org/1999/xhtml}body")
-    e = collections.Counter([(X.tag, X.get("class", ""), X.get("style", "")) for X in body.iter()])
-    print("The following tags were found as descendants of body:")
+    files = {}
+    for filename in args["load"] or []:
+        files.update(load_inventory(filename))
+    cache = {} if args["no_cache"] else load_cache(args["cache"])
+    found, cached = inventory_files(find_files(args["input"]), args["jobs"], cache)
+    files.update(found)
+    if not args["no_cache"] and len(found) > cached:
+        os.makedirs(os.path.dirname(os.path.abspath(args["cache"])), exist_ok=True)
+        with open(args["cache"], "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    e = total(files.values())
+    #text output is left out when the JSON goes to stdout
+    out = open(os.devnull, "w") if args["json"] == "-" else sys.stdout
+    if len(files) > 1:
+        print("Inventory of %d files (%d read or from server, %d cached, %d loaded):" %
+              (len(files), len(found) - cached, cached, len(files) - len(found)), file=out)
+    print("The following tags were found as descendants of body:", file=out)
     for p, n in e.most_common():
-        s = p[0].replace("{http://www.w3.org/1999/xhtml}", "")
-        if p[1]: s += " class=\"" + p[1] + "\""
-        if p[2]: s += " style=\"" + p[2] + "\""
-        print(" ", n, ":", s)
+        print(" ", n, ":", describe(p), file=out)
+    if args["diff"]:
+        d = total(load_inventory(args["diff"]).values())
+        changes = sorted(((e[k] - d[k], k) for k in set(e) | set(d) if e[k] != d[k]),
+                         key=lambda x: (-abs(x[0]), describe(x[1])))
+        print("Changes since %s:" % args["diff"], file=out)
+        for n, p in changes:
+            print(" ", "%+d" % n, ":", describe(p), file=out)
+    if args["json"]:
+        inventory = {"files": files,
+                     "total": [list(k) + [n] for k, n in e.most_common()]}
+        if args["json"] == "-":
+            json.dump(inventory, sys.stdout, indent=1)
+            print()
+        else:
+            with open(args["json"], "w", encoding="utf-8") as f:
+                json.dump(inventory, f, indent=1)
 
 
 if __name__ == "__main__":
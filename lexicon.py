@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import argparse
+import sqlite3
+
+default_lexicon = os.path.join(os.path.expanduser("~"), ".ebook_lexicon.sqlite")
+
+schema = """\
+CREATE TABLE IF NOT EXISTS forms (
+  form TEXT PRIMARY KEY,
+  rform TEXT NOT NULL,
+  dialect INTEGER NOT NULL DEFAULT 0,
+  quote INTEGER NOT NULL DEFAULT 0,
+  books INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS forms_rform ON forms (rform);
+CREATE TABLE IF NOT EXISTS book_forms (
+  book TEXT NOT NULL,
+  form TEXT NOT NULL,
+  PRIMARY KEY (book, form));
+CREATE TABLE IF NOT EXISTS overrides (
+  book TEXT NOT NULL,
+  form TEXT NOT NULL,
+  dialect INTEGER NOT NULL,
+  PRIMARY KEY (book, form));
+"""
+
+
+class Lexicon:
+    """Persistent record of the decisions made about single quotes in word forms
+    such as 'em, 'tis or o'. Forms are stored in the same form as the keys of the
+    pretty_punc dialect dictionary. For each form the number of times it has been
+    declared dialect and the number of times it has been declared a quote are
+    kept, along with the number of books it has been seen in. A form is treated
+    as dialect if it has more dialect than quote decisions, unless this is
+    overridden for a particular book."""
+
+    def __init__(self, filename=default_lexicon):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def dialect_forms(self, book=None):
+        """Returns a dialect dictionary of the form {form: replacement, ..} for all
+        dialect forms, taking into account the overrides for book."""
+        forms = set(X[0] for X in self.db.execute(
+            "SELECT form FROM forms WHERE dialect > quote"))
+        if book:
+            for form, dialect in self.db.execute(
+                    "SELECT form, dialect FROM overrides WHERE book = ?", (book,)):
+                if dialect: forms.add(form)
+                else: forms.discard(form)
+        return {X: X.replace("'", "\u02bc") for X in forms}
+
+    def lookup(self, form, book=None):
+        """Returns True if form is dialect, False if it is a quote and None if it
+        is unknown."""
+        if book:
+            r = self.db.execute("SELECT dialect FROM overrides WHERE book = ? AND form = ?",
+                                (book, form)).fetchone()
+            if r: return bool(r[0])
+        r = self.db.execute("SELECT dialect, quote FROM forms WHERE form = ?",
+                            (form,)).fetchone()
+        if not r or r[0] == r[1]: return None
+        return r[0] > r[1]
+
+    def prefixed(self, prefix):
+        """Returns the forms that start with prefix (e.g. "'" for forms like 'em)."""
+        return [X[0] for X in self.db.execute(
+            "SELECT form FROM forms WHERE form >= ? AND form < ? ORDER BY form",
+            (prefix, prefix + "\U0010ffff"))]
+
+    def suffixed(self, suffix):
+        """Returns the forms that end with suffix (e.g. "'" for forms like o')."""
+        rsuffix = suffix[::-1]
+        return [X[0] for X in self.db.execute(
+            "SELECT form FROM forms WHERE rform >= ? AND rform < ? ORDER BY rform",
+            (rsuffix, rsuffix + "\U0010ffff"))]
+
+    def record(self, form, dialect=0, quote=0, book=None):
+        books = 0
+        if book:
+            books = self.db.execute(
+                "INSERT OR IGNORE INTO book_forms (book, form) VALUES (?, ?)",
+                (book, form)).rowcount
+        self.db.execute(
+            "INSERT INTO forms (form, rform, dialect, quote, books) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (form) DO UPDATE SET dialect = dialect + excluded.dialect, "
+            "quote = quote + excluded.quote, books = books + excluded.books",
+            (form, form[::-1], dialect, quote, books))
+
+    def record_book(self, book, answers):
+        """Record the answers to pretty_punc queries made while processing book.
+        answers is a list of the form [(form, answer), ..] where answer is one of
+        the query_single answers. Marked quotes are not recorded."""
+        for form, answer in answers:
+            if answer == "d":
+                self.record(form, dialect=1, book=book)
+            elif answer in ("<", ">"):
+                self.record(form, quote=1, book=book)
+        self.db.commit()
+
+    def override(self, book, form, dialect):
+        """Override the decision for form in book. dialect of None removes the
+        override."""
+        if dialect is None:
+            self.db.execute("DELETE FROM overrides WHERE book = ? AND form = ?",
+                            (book, form))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO overrides (book, form, dialect) "
+                            "VALUES (?, ?, ?)", (book, form, int(dialect)))
+        self.db.commit()
+
+    def export_forms(self, f):
+        for row in self.db.execute(
+                "SELECT form, dialect, quote, books FROM forms ORDER BY form"):
+            f.write("%s\t%s\t%s\t%s\n" % row)
+
+    def import_forms(self, f):
+        """Import forms in the format written by export_forms. Counts are added to
+        any already recorded."""
+        c = 0
+        for l in f:
+            fields = l.rstrip("\n").split("\t")
+            if len(fields) != 4: continue
+            form, dialect, quote, books = fields
+            self.record(form, int(dialect), int(quote))
+            self.db.execute("UPDATE forms SET books = books + ? WHERE form = ?",
+                            (int(books), form))
+            c += 1
+        self.db.commit()
+        return c
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description="Maintain the lexicon of dialect forms used by pretty_punc.py.")
+    parser.add_argument("-l", "--lexicon", default=default_lexicon,
+                        help="Lexicon database (default: %s)" % default_lexicon)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("export", help="Export forms as tab separated text")
+    p.add_argument("file", nargs="?", default="-", help="Output file (default: stdout)")
+    p = subparsers.add_parser("import", help="Import forms from tab separated text")
+    p.add_argument("file", nargs="?", default="-", help="Input file (default: stdin)")
+    p = subparsers.add_parser("search", help="List forms with a given prefix or suffix")
+    p.add_argument("--prefix", default="", help="Prefix to match (e.g. \"'\")")
+    p.add_argument("--suffix", help="Suffix to match (e.g. \"'\")")
+    p = subparsers.add_parser("override", help="Override the decision for a form in one book")
+    p.add_argument("book", help="Book name (as given to pretty_punc.py --book)")
+    p.add_argument("form", help="Word form (e.g. \"'em\")")
+    p.add_argument("decision", choices=("dialect", "quote", "clear"))
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_command_line()
+    lexicon = Lexicon(args["lexicon"])
+    if args["command"] == "export":
+        if args["file"] == "-":
+            lexicon.export_forms(sys.stdout)
+        else:
+            with open(args["file"], "w", encoding="utf-8") as f:
+                lexicon.export_forms(f)
+    elif args["command"] == "import":
+        if args["file"] == "-":
+            c = lexicon.import_forms(sys.stdin)
+        else:
+            with open(args["file"], encoding="utf-8") as f:
+                c = lexicon.import_forms(f)
+        print("Imported", c, "forms")
+    elif args["command"] == "search":
+        if args["suffix"] is not None:
+            forms = lexicon.suffixed(args["suffix"])
+        else:
+            forms = lexicon.prefixed(args["prefix"])
+        for f in forms:
+            print(f, {True: "dialect", False: "quote", None: "undecided"}[lexicon.lookup(f)])
+    elif args["command"] == "override":
+        d = {"dialect": True, "quote": False, "clear": None}[args["decision"]]
+        lexicon.override(args["book"], args["form"], d)
+    lexicon.close()
+
+
+if __name__ == "__main__":
+    main()
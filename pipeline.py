@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import shlex
+import argparse
+import collections
+import xml.etree.ElementTree as ET
+import common
+import replace_tag
+import bspsplit
+import haines_poem
+import pretty_punc
+import recombine
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description=("Run replace_tag.py, bspsplit.py, haines_poem.py, pretty_punc.py and "
+                     "recombine.py over an xhtml file in one process, in that order. The "
+                     "file is parsed once, the tools work on the tree in memory and only "
+                     "the final result is written. A tool is only run if its option is "
+                     "given. Options for the tools are given as a single argument, e.g. "
+                     "--pretty-punc='--batch -l'. If bspsplit is run, haines_poem works "
+                     "on the skeleton, pretty_punc on the bsps, and the two are "
+                     "recombined at the end."))
+    parser.add_argument("input", help="XML Input file")
+    parser.add_argument("-o", "--output", default="recombined.xhtml",
+                        help="Output file name (default: 'recombined.xhtml')")
+    parser.add_argument("--replace-tag", metavar="ARGS",
+                        help="Run replace_tag with these arguments (rules and options)")
+    parser.add_argument("--bspsplit", metavar="ARGS",
+                        help="Run bspsplit with these arguments ('' for defaults)")
+    parser.add_argument("--haines-poem", action="store_true",
+                        help="Run haines_poem")
+    parser.add_argument("--pretty-punc", metavar="ARGS",
+                        help="Run pretty_punc with these arguments ('' for defaults)")
+    parser.add_argument("--notitle", action="store_true",
+                        help="Do not insert title page when recombining.")
+    parser.add_argument("-c", "--checkpoint", metavar="DIR",
+                        help="Also write the tree after each step to a file in DIR")
+    return vars(parser.parse_args())
+
+
+class Checkpoints:
+    """Writes numbered copies of the trees between steps, if a directory
+    has been given for them."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.count = 0
+        if directory: os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, name, tree):
+        if not self.directory: return
+        self.count += 1
+        filename = os.path.join(self.directory, "%02d-%s.xhtml" % (self.count, name))
+        tree.write(filename, encoding="unicode", xml_declaration=True)
+        print("Wrote checkpoint", filename)
+
+
+def run(args):
+    """Runs the steps given by args over the input file, writing the
+    result to the output file."""
+    checkpoint = Checkpoints(args["checkpoint"])
+    tree = common.parse_xhtml(args["input"])
+    if args["replace_tag"] is not None:
+        print("Running replace_tag")
+        rt_args = replace_tag.parse_arguments([args["input"]] + shlex.split(args["replace_tag"]))
+        replace_tag.apply(common.DocIndex(tree.getroot()), replace_tag.make_rules(rt_args),
+                          rt_args["clear"])
+        common.splice_removed(tree.getroot())
+        checkpoint("replace_tag", tree)
+    bsp_tree = None
+    if args["bspsplit"] is not None:
+        print("Running bspsplit")
+        bs_args = bspsplit.parse_command_line([args["input"]] + shlex.split(args["bspsplit"]))
+        bsp_tree, bsp_count, blocks, fail = bspsplit.split_tree(tree, bs_args)
+        bspsplit.report(bsp_count, len(blocks), collections.Counter(bspsplit.fail_keys(fail)))
+        checkpoint("skeleton", tree)
+        checkpoint("bsps", bsp_tree)
+    if args["haines_poem"]:
+        print("Running haines_poem")
+        haines_poem.fix_poems(tree.getroot())
+        common.splice_removed(tree.getroot())
+        checkpoint("haines_poem", tree)
+    if args["pretty_punc"] is not None:
+        print("Running pretty_punc")
+        pp_args = pretty_punc.parse_command_line([args["input"]] + shlex.split(args["pretty_punc"]))
+        pp_tree = tree if bsp_tree is None else bsp_tree
+        pretty_punc.process_tree(pp_tree.getroot(), pp_args)
+        checkpoint("pretty_punc", pp_tree)
+    if bsp_tree is not None:
+        print("Running recombine")
+        uses, unknown = recombine.recombine_tree(tree, bsp_tree, args["notitle"])
+        recombine.report(uses, unknown, range(bsp_count))
+    common.backup_file(args["output"])
+    tree.write(args["output"], encoding="unicode", xml_declaration=True)
+    print("Wrote", args["output"])
+
+
+def main():
+    ET.register_namespace('', "http://www.w3.org/1999/xhtml")
+    args = parse_command_line()
+    if not os.path.isfile(args["input"]):
+        print("Error:", args["input"], "is not a file")
+        sys.exit(-1)
+    run(args)
+
+
+if __name__ == "__main__": main()
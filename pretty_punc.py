@@ -2,13 +2,16 @@
 
 import xml.etree.ElementTree as et
 import sys
-import html.entities
+import hashlib
 import re
 import shutil
 import argparse
 import os
 import tty
 import termios
+import multiprocessing
+import lexicon
+import common
 
 #note unicode escapes:
 #\u2018 is left single quote ‘
@@ -32,56 +35,222 @@ def process_doubles(p):
     return p
 
 
-def query_single(s, start, end, dialect):
-    context = 200#change this to show more or less context for query
+class Journal:
+    """Record of the answers given to query_single. Each answer is appended to the
+    journal file as soon as it is given, keyed by block index and a hash of the
+    text surrounding the quote, so that an interrupted or repeated run can replay
+    them. Lines have the form block<TAB>context_hash<TAB>answer<TAB>word. Answers
+    that apply to every occurrence of a word form have a block of "*" and no
+    context hash."""
+
+    def __init__(self, filename=None, replay_only=False):
+        self.block = 0
+        self.replay_only = replay_only
+        self.replayed, self.unresolved = 0, 0
+        self.exact, self.by_context, self.by_word = {}, {}, {}
+        self.pending = None#{word: [count, s, pos], ..} while pre-scanning
+        self.answers = []#[(word, answer), ..] for answers given during this run
+        self.f = None
+        if not filename: return
+        if os.path.exists(filename):
+            for l in open(filename, encoding="utf-8"):
+                fields = l.rstrip("\n").split("\t")
+                if len(fields) != 4: continue
+                if fields[0] == "*":
+                    self.by_word[fields[3]] = fields[2]
+                    continue
+                self.exact[(fields[0], fields[1])] = fields[2]
+                self.by_context[fields[1]] = fields[2]
+        self.f = open(filename, "a", encoding="utf-8")
+
+    def lookup(self, context_hash, word):
+        """Returns the recorded answer for context_hash, preferring one made in the
+        current block, then one made for the word form, or None. Falling back to any
+        block allows decisions to be replayed after blocks have been added or removed
+        upstream."""
+        t = self.exact.get((str(self.block), context_hash),
+                           self.by_context.get(context_hash, self.by_word.get(word)))
+        if t and self.pending is None: self.replayed += 1
+        return t
+
+    def record(self, context_hash, answer, word):
+        self.exact[(str(self.block), context_hash)] = answer
+        self.by_context[context_hash] = answer
+        self.answers.append((word, answer))
+        if self.f:
+            self.f.write("%s\t%s\t%s\t%s\n" % (self.block, context_hash, answer, word))
+            self.f.flush()
+
+    def record_word(self, word, answer):
+        self.by_word[word] = answer
+        self.answers.append((word, answer))
+        if self.f:
+            self.f.write("*\t\t%s\t%s\n" % (answer, word))
+            self.f.flush()
+
+    def collect(self, word, s, pos):
+        if word in self.pending:
+            self.pending[word][0] += 1
+        else:
+            self.pending[word] = [1, s, pos]
+
+    def close(self):
+        if self.f: self.f.close()
+
+
+def context_hash(s, pos):
+    """Hash of the text immediately surrounding the quote at pos."""
+    context = 40
+    return hashlib.sha1(s[max(pos - context, 0):pos + context + 1].encode()).hexdigest()[:16]
+
+
+re_word = re.compile(r"\w+")
+
+
+def single_word(s, pos):
+    """Returns the word parts either side of the single quote at pos."""
+    #scan back from the quote rather than searching the whole text before it.
+    #\w is what str.isalnum accepts, and _
+    start = pos
+    while start > 0 and (s[start - 1].isalnum() or s[start - 1] == "_"): start -= 1
+    m = re_word.match(s, pos + 1)
+    return s[start:pos], (m.group(0) if m else "")
+
+
+#characters either side of a quote shown when asking about it
+query_context = 200#change this to show more or less context for query
+
+
+def ask_single(s, pos, allow_skip=False):
+    context = query_context
+    answers = ["<", ">", "m", "d", ",", "."]
+    if allow_skip: answers.append("s")
     old_settings = termios.tcgetattr(sys.stdin)
     try:
         tty.setcbreak(sys.stdin)
-        while True:
-            s = replace_dialect(s, dialect)
-            pos = s.find("'", start, end)
-            if pos == -1: return s
-            t = ""
-            while t not in ("<", ">", "m", "d", ",", "."):
-                query_line = (s[max(pos - context, 0):pos] +
-                              "\033[31m[\033[0m" + s[pos] + "\033[31m]\033[0m" +
-                              s[pos + 1:min(pos + context, len(s))])
-                print(re.sub(r"\s+", " ", query_line))
-                sys.stdout.write("[<,>,m,d,?] : ")
-                sys.stdout.flush()
-                t = sys.stdin.read(1)
-                if t == ",": t = "<"
-                if t == ".": t = ">"
-                sys.stdout.write(t + "\n")
-                if t == "?":
-                    print("\n<:opening single   >:closing single/apostrophe   m:mark   d:dialect\n")
-            if t == "<":
-                s = s[:pos] + "\u2018" + s[pos + 1:]
-            elif t == ">":
-                s = s[:pos] + "\u2019" + s[pos + 1:]
-            elif t == "d":
-                s = s[:pos] + "\u02bc" + s[pos + 1:]
-                #record dialect word
-                e = re.search(r"\w+$", s[:pos])
-                m = re.search(r"^\w+", s[pos + 1:])
-                dialect_word_start = e.group(0) if e else ""
-                dialect_word_end = m.group(0) if m else ""
-                dialect[dialect_word_start + "'" + dialect_word_end] = (
-                    dialect_word_start + u"\u02bc" + dialect_word_end)
-            print()
-            start = pos + 1
+        t = ""
+        while t not in answers:
+            query_line = (s[max(pos - context, 0):pos] +
+                          "\033[31m[\033[0m" + s[pos] + "\033[31m]\033[0m" +
+                          s[pos + 1:min(pos + context, len(s))])
+            print(re.sub(r"\s+", " ", query_line))
+            sys.stdout.write("[<,>,m,d,%s?] : " % ("s," if allow_skip else ""))
+            sys.stdout.flush()
+            t = sys.stdin.read(1)
+            if t == ",": t = "<"
+            if t == ".": t = ">"
+            sys.stdout.write(t + "\n")
+            if t == "?":
+                print("\n<:opening single   >:closing single/apostrophe   m:mark   d:dialect" +
+                      ("   s:skip (ask about each occurrence)" if allow_skip else "") + "\n")
+        print()
+        return t
     finally:
         termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
 
 
+def query_single(buf, start, end, dialect, journal=None):
+    """Curls the straight single quotes in buf[start:end], asking about each
+    one unless journal has an answer for it. buf is the paragraph as a list
+    of characters and is changed in place."""
+    while True:
+        try:
+            pos = buf.index("'", start, end)
+        except ValueError:
+            return
+        #everything below only needs the text around the quote, so only that
+        #is joined rather than the whole paragraph
+        offset = max(pos - query_context, 0)
+        s = "".join(buf[offset:pos + query_context + 1])
+        word_start, word_end = single_word(s, pos - offset)
+        word = word_start + "'" + word_end
+        if journal:
+            ch = context_hash(s, pos - offset)
+            t = journal.lookup(ch, word)
+            if not t:
+                if journal.pending is not None:
+                    #pre-scanning for batch_query: note the quote and leave it
+                    journal.collect(word, s, pos - offset)
+                    t = "m"
+                elif journal.replay_only:
+                    #leave the quote straight so that it is marked
+                    journal.unresolved += 1
+                    t = "m"
+                else:
+                    t = ask_single(s, pos - offset)
+                    journal.record(ch, t, word)
+        else:
+            t = ask_single(s, pos - offset)
+        if t == "<":
+            buf[pos] = "\u2018"
+            replace_dialect_at(buf, pos, dialect)
+        elif t == ">":
+            buf[pos] = "\u2019"
+            replace_dialect_at(buf, pos, dialect)
+        elif t == "d":
+            buf[pos] = "\u02bc"
+            #record dialect word
+            dialect[word] = (
+                word_start + u"\u02bc" + word_end)
+            #the new dialect word may occur anywhere in the paragraph.
+            #Replacements never change the length of the text.
+            buf[:] = replace_dialect("".join(buf), dialect)
+        start = pos + 1
+
+
+
+#Dialect words are always of the form \w*'\w*, so rather than running a regex per
+#dialect word, every run of word characters and straight quotes in the paragraph is
+#found in a single scan and the words it could hold are looked up in the dialect
+#dictionary. The cost is therefore independent of the number of dialect words known,
+#and words added by query_single take effect immediately without any recompilation.
+re_dialect_run = re.compile(r"[\w']*'[\w']*")
+re_dialect_error = re.compile(r"(?<!\w)\u2018\w*(?!\w)")
+
+
+def dialect_run(run, dialect):
+    """Replaces the dialect words in a run of word characters and straight
+    quotes. A word may start at the start of the run or after a quote (as in
+    'nothin', an opening quote followed by nothin'), and takes in the first
+    quote from there and the word characters after it."""
+    if run in dialect: return dialect[run]
+    parts, i, done = [], 0, 0
+    while True:
+        q = run.find("'", i)
+        if q == -1: break
+        end = run.find("'", q + 1)
+        if end == -1: end = len(run)
+        word = run[i:end]
+        if word in dialect:
+            parts.append(run[done:i])
+            parts.append(dialect[word])
+            done = end
+            #a word can only start at a quote if a quote comes before it
+            i = end if run[end - 1] == "'" else end + 1
+        else:
+            i = q + 1
+    if not parts: return run
+    parts.append(run[done:])
+    return "".join(parts)
+
 
 def replace_dialect(p, dialect):
-    for k in dialect:
-        p = re.sub("(^|\\W)%s($|\\W)" % k, "\\1%s\\2" % dialect[k], p)
-    return p
+    if not dialect or p.find("'") == -1: return p
+    return re_dialect_run.sub(lambda m: dialect_run(m.group(0), dialect), p)
+
+
+def replace_dialect_at(buf, pos, dialect):
+    """As replace_dialect, but for the paragraph as a list of characters after
+    the character at pos has been changed. A dialect word never spans white
+    space, so only the run of other characters around pos is replaced."""
+    if not dialect: return
+    start, end = pos, pos + 1
+    while start > 0 and not buf[start - 1].isspace(): start -= 1
+    while end < len(buf) and not buf[end].isspace(): end += 1
+    buf[start:end] = replace_dialect("".join(buf[start:end]), dialect)
 
 
-def process_singles(p, dialect):
+def process_singles(p, dialect, journal=None):
     """Process a paragraph to curl single quotes. It is assumed that apostrophes and
     double quotes are already curled before calling this function."""
     re_close = re.compile("'([\\s\u201d.,;:!]|$)")
@@ -91,6 +260,9 @@ def process_singles(p, dialect):
     p = re_close.sub('\u2019\\1', p)
     #break the para into sections on these closing single quotes.
     sections = p.split("\u2019")
+    #all edits below replace one character with another, so they are made in a
+    #mutable buffer, which is only joined once the whole paragraph is done
+    buf = list(p)
     pos = 0
     for s in sections[:-1]:
         #any remaining quotes in section are candidates for being openers -- anything
@@ -100,9 +272,9 @@ def process_singles(p, dialect):
         #if we only find one candidate, assume it is the paired opening quote and hence we've
         #correctly split on a closing quote
         if candidate_openers == 1:
-            s = s.replace("'", "\u2018")
+            buf[pos + s.find("'")] = "\u2018"
+            replace_dialect_at(buf, pos + s.find("'"), dialect)
             s += "\u2019"
-            p = p[:pos] + s + p[pos + len(s):]
         #if there is no candidate opening quote, we've likely mistaken an apostrophe
         #for a closing quote - put the straight quote back to trigger query
         else:
@@ -113,79 +285,231 @@ def process_singles(p, dialect):
                 #apostrophe.  Assume that we were correct in the original diagnosis of a closing
                 #single, but leave the candidates unchanged
                 s += "\u2019"
-            #splice s back into p and hand it off for interactive query
-            p = p[:pos] + s + p[pos + len(s):]
-            p = query_single(p, pos, pos + len(s), dialect)
+            #put any straight quote back and hand the section off for
+            #interactive query
+            buf[pos + len(s) - 1] = s[-1]
+            replace_dialect_at(buf, pos + len(s) - 1, dialect)
+            query_single(buf, pos, pos + len(s), dialect, journal)
         pos += len(s)
     #anything in last section needs querying
-    p = query_single(p, pos, pos + len(sections[-1]), dialect)
-    return p
+    query_single(buf, pos, pos + len(sections[-1]), dialect, journal)
+    return "".join(buf)
 
 
-def process_para(p, dialect):
+def prepare_para(p):
+    """The part of process_para that depends only on the text of the paragraph."""
     if p.find("'") == -1 and p.find('"') == -1:
         return p
     #replace suspected apostrophes with \u02bc
     #intraword replacement - do it a twice to catch overlapping cases
     for i in range(2): p = re.sub(r"(\w)'(\w)", "\\1\u02bc\\2", p)
     p = re.sub(r"s'", "s\u02bc", p)
-    #do processing
     p = process_doubles(p)
-    p = process_singles(p, dialect)
     return p
 
 
-def curlify_element(e, dialect, skip_quote_count=False):
+def process_para(p, dialect, journal=None):
+    if p.find("'") == -1 and p.find('"') == -1:
+        return p
+    #do processing
+    p = prepare_para(p)
+    p = process_singles(p, dialect, journal)
+    return p
+
+
+def flatten_element(e):
+    """Returns (segments, text) where text is the text of e, excluding its tail,
+    and segments is a table of (element, "text"|"tail", offset) for each piece
+    of text in document order."""
     #Text in element looks like e.g.:
     #el_text<se>se_text<sse>sse_text</sse>sse_tail</se>se_tail<se>se_text</se>se_tail
     #where <se> and <sse> represent the positions of sub(sub)-elements and don't contribute
-    #text.
-    text_blocks = []
+    #text. The segment table records the offset of each piece into the flattened text,
+    #so that the processed text can be written back in a single pass.
+    segments, text_blocks = [], []
+    offset = 0
     def flatten_text(e):
-        text_blocks.append(e.text or "")
+        nonlocal offset
+        t = e.text or ""
+        segments.append((e, "text", offset))
+        text_blocks.append(t)
+        offset += len(t)
         for se in e:
             flatten_text(se)
-        text_blocks.append(e.tail or "")
+            t = se.tail or ""
+            segments.append((se, "tail", offset))
+            text_blocks.append(t)
+            offset += len(t)
     flatten_text(e)
-    text = "".join(text_blocks[:-1])
+    return segments, "".join(text_blocks)
+
+
+def unflatten_element(segments, text):
+    """Write text back into the tree using a segment table from flatten_element.
+    text must be the same length as the text that was flattened."""
+    ends = [X[2] for X in segments[1:]] + [len(text)]
+    for (el, attr, start), end in zip(segments, ends):
+        setattr(el, attr, text[start:end])
+
+
+def curlify_element(e, dialect, skip_quote_count=False, journal=None):
+    segments, text = flatten_element(e)
     if not text: return
-    text = process_para(text, dialect)
+    text = process_para(text, dialect, journal)
     if not skip_quote_count:
         text = quote_balance_check(text)
     #we now have a processed text string and need to fit the modified version back into
-    #the tree.
-    text += text_blocks[-1]
-    c = 0
-    def unflatten_text(e):
-        nonlocal text, c
-        e.text = text[:len(text_blocks[c])]
-        text = text[len(text_blocks[c]):]
-        c += 1
-        for se in e:
-            unflatten_text(se)
-        e.tail = text[:len(text_blocks[c])]
-        text = text[len(text_blocks[c]):]
-        c += 1
-    unflatten_text(e)
+    #the tree. Processing never changes the length of the text.
+    unflatten_element(segments, text)
+
+
+def block_levels(blocks):
+    """Group blocks into levels such that, of two blocks one of which contains
+    the other (e.g. a p in an included div), the one that comes first in blocks
+    is in an earlier level, as the serial loop processes it first. Blocks in
+    the same level never overlap, so can be processed independently, and are
+    kept in the order of blocks."""
+    order = {b: c for c, b in enumerate(blocks)}
+    earlier = {}#{block: [overlapping blocks that come before it], ..}
+    for b in blocks:
+        for X in b.iter():
+            if X is not b and X in order:
+                first, second = (b, X) if order[b] < order[X] else (X, b)
+                earlier.setdefault(second, []).append(first)
+    level, levels = {}, {}
+    for c, b in enumerate(blocks):
+        level[b] = 1 + max([level[X] for X in earlier.get(b, [])], default=-1)
+        levels.setdefault(level[b], []).append((c, b))
+    return [levels[X] for X in sorted(levels)]
+
+
+def curlify_blocks(blocks, dialect, skip_quote_count=False, journal=None, pool=None):
+    """Curlify each block in turn. If pool is given, the parts of the processing
+    that depend only on the text of each block are run in the pool and only the
+    curling of single quotes, which may need to ask questions, is run here."""
+    ble = len(blocks)
+    if not pool:
+        for c, se in enumerate(blocks):
+            print(c + 1, "of", ble)
+            if journal: journal.block = c
+            curlify_element(se, dialect, skip_quote_count, journal)
+        return
+    for level in block_levels(blocks):
+        flat = [flatten_element(X[1]) for X in level]
+        texts = pool.map(prepare_para, [X[1] for X in flat])
+        for i, (c, se) in enumerate(level):
+            print(c + 1, "of", ble)
+            if journal: journal.block = c
+            #the same test as process_para's, on the text before preparation
+            text = flat[i][1]
+            if text.find("'") != -1 or text.find('"') != -1:
+                texts[i] = process_singles(texts[i], dialect, journal)
+        if not skip_quote_count:
+            texts = pool.map(quote_balance_check, texts)
+        for (segments, text), processed_text in zip(flat, texts):
+            if text: unflatten_element(segments, processed_text)
+
+
+def batch_query(blocks, dialect, journal):
+    """Pre-scan all blocks for quotes that would need to be queried and ask about
+    them once per word form, most frequent first. The answers are recorded in the
+    journal and applied to every occurrence of the word form when the blocks are
+    processed."""
+    journal.pending = {}
+    for c, b in enumerate(blocks):
+        journal.block = c
+        text = flatten_element(b)[1]
+        if text: process_para(text, dict(dialect), journal)
+    pending, journal.pending = journal.pending, None
+    clusters = sorted(pending.items(), key=lambda X: (-X[1][0], X[0]))
+    print(len(clusters), "word forms to query")
+    for c, (word, (count, s, pos)) in enumerate(clusters):
+        print("%s of %s: %s (%s occurrences)" % (c + 1, len(clusters), word, count))
+        t = ask_single(s, pos, allow_skip=True)
+        if t != "s": journal.record_word(word, t)
+
+
+re_char_class = re.compile(r"\[([^\]\\^-]+)\]")
+regex_metachars = set(".^$*+?{}[]\\|()")
+
+
+def compile_rules(*rmaps):
+    """Compile one or more rmaps into a single ordered rule list for replace_text.
+    Each rmap entry is [pattern, replacement] or [pattern, replacement, count],
+    where count is incremented with the number of substitutions made. Rules that
+    map single characters to single characters are folded into str.translate
+    tables, literal rules use str.replace and only the rest use regexes."""
+    rules = []
+    for rmap in rmaps:
+        for r in rmap:
+            pattern, repl = r[0], r[1]
+            counter = r if len(r) == 3 else None
+            literal = not regex_metachars.intersection(pattern)
+            mo = re_char_class.fullmatch(pattern)
+            if (counter is None and len(repl) == 1 and repl != "\\" and
+                (mo or (literal and len(pattern) == 1))):
+                table = {ord(c): repl for c in (mo.group(1) if mo else pattern)}
+                if rules and rules[-1][0] == "tr":
+                    #compose with the preceding table so it is still one pass
+                    prev = rules[-1][1]
+                    for k, v in prev.items():
+                        if ord(v) in table: prev[k] = table[ord(v)]
+                    for k, v in table.items():
+                        prev.setdefault(k, v)
+                else:
+                    rules.append(("tr", table, None, None))
+            elif literal and repl.find("\\") == -1:
+                rules.append(("str", pattern, repl, counter))
+            else:
+                rules.append(("re", re.compile(pattern), repl, counter))
+    return rules
 
 
-def fix_entities(text):
-    repl = html.entities.entitydefs
-    for e in ["quot", "amp", "apos", "lt", "gt"]:
-        if e in repl: del repl[e]
-    for e in repl:
-        text = text.replace("&" + e + ";", repl[e])
+def apply_rules(text, rules):
+    for kind, a, b, counter in rules:
+        if kind == "tr":
+            text = text.translate(a)
+        elif kind == "str":
+            if counter: counter[2] += text.count(a)
+            text = text.replace(a, b)
+        else:
+            text, c = a.subn(b, text)
+            if counter: counter[2] += c
     return text
 
 
-def replace_text(e, rep_map):
+def apply_rules_chunk(chunk):
+    """Apply rules to a list of texts in a pool worker, returning the new texts and
+    the number of substitutions made for each counted rule."""
+    texts, rules = chunk
+    before = [X[3][2] if X[3] else 0 for X in rules]
+    texts = [apply_rules(X, rules) for X in texts]
+    return texts, [(X[3][2] - b) if X[3] else 0 for X, b in zip(rules, before)]
+
+
+def replace_text(e, rules, pool=None):
+    """Apply compiled rules (see compile_rules) to all text and tails in e, in a
+    single traversal. If pool is given the texts are processed in chunks in the
+    pool."""
+    if not pool:
+        for se in e.iter():
+            if se.text: se.text = apply_rules(se.text, rules)
+            if se.tail: se.tail = apply_rules(se.tail, rules)
+        return
+    targets = []
     for se in e.iter():
-        c_text, c_tail = 0, 0
-        for r in rep_map:
-            if se.text: se.text, c_text = re.subn(r[0], r[1], se.text)
-            if se.tail: se.tail, c_tail = re.subn(r[0], r[1], se.tail)
-            if len(r) == 3:
-                r[2] += c_text + c_tail
+        if se.text: targets.append((se, "text"))
+        if se.tail: targets.append((se, "tail"))
+    texts = [getattr(*X) for X in targets]
+    chunk_len = 1000
+    chunks = [(texts[X:X + chunk_len], rules) for X in range(0, len(texts), chunk_len)]
+    c = 0
+    for new_texts, counts in pool.imap(apply_rules_chunk, chunks):
+        for t in new_texts:
+            setattr(targets[c][0], targets[c][1], t)
+            c += 1
+        for r, n in zip(rules, counts):
+            if r[3]: r[3][2] += n
 
 
 def quote_balance_check(qb_text):
@@ -205,7 +529,7 @@ def quote_balance_check(qb_text):
     return qb_text
 
 
-def parse_command_line():
+def parse_command_line(argv=None):
     parser = argparse.ArgumentParser(
         description=("Process an xhtml file containing straight quotes into "
                      "one containing curly quotes. Old file copied with .old suffix."))
@@ -221,9 +545,30 @@ def parse_command_line():
                         help="Don't attempt to change ellipses to utf-8 character method.")
     parser.add_argument("-i", "--include", action="append",
                         help="Include additional block with form tag[.class] (e.g. div or div.poem)")
+    parser.add_argument("--journal",
+                        help=("File in which to record answers to queries so that they can "
+                              "be replayed on later runs (default: filename.journal)"))
+    parser.add_argument("--no-journal", action="store_true",
+                        help=("Don't read or write a journal file. Answers are still "
+                              "reused for the same context within the run."))
+    parser.add_argument("--replay-only", action="store_true",
+                        help=("Replay answers from the journal without asking any questions. "
+                              "Unresolved quotes are marked."))
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help=("Pre-scan the file and ask about each ambiguous word form once, "
+                              "applying the answer to all of its occurrences."))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=("Number of processes to use for the parts of the processing "
+                              "that don't need interaction (default: 1)"))
+    parser.add_argument("-l", "--lexicon", nargs="?", const=lexicon.default_lexicon,
+                        help=("Use dialect forms from, and record answers in, the lexicon "
+                              "database (default: %s)" % lexicon.default_lexicon))
+    parser.add_argument("--book",
+                        help=("Name of book for lexicon overrides "
+                              "(default: name of directory containing filename)"))
     parser.add_argument("filename", nargs="?", default="bsps.xhtml",
                         help="File to process (xhtml format, utf-8 encoding)")
-    args = vars(parser.parse_args())
+    args = vars(parser.parse_args(argv))
     if not os.path.isfile(args["filename"]):
         print("Error: ", args["filename"], "is not a file")
         sys.exit(-1)
@@ -231,42 +576,38 @@ def parse_command_line():
 
 
 def build_block_list(tree, args):
+    index = common.DocIndex(tree)
     blocks = []
     for tag in ("p", "h1", "h2", "h3"):
-        blocks.extend(tree.findall(".//{http://www.w3.org/1999/xhtml}" + tag))
-    inc = args["include"] or []
-    for i in inc:
-        s = i.split(".")
-        t = tree.findall(
-            ".//{http://www.w3.org/1999/xhtml}" + s[0])
-        if len(s) == 1: #no class specified
-            blocks.extend(t)
-        else: #use substring to allow for multiple classes
-            for e in t:
-                c = e.attrib.get("class", "")
-                if (c.find(s[1]) != -1):
-                    blocks.append(e)
-    return blocks
+        blocks.extend(index.elements(tag))
+    for i in args["include"] or []:
+        #a class matches any one of an element's classes
+        blocks.extend(index.select(i))
+    #an element picked out more than once is only processed once
+    return list(dict.fromkeys(blocks))
 
 
 def fix_dialect_errors(blocks, dialect):
+    #dialect words starting with an apostrophe may have been curled as opening
+    #quotes before they were recognised as dialect
+    errors = {"\u2018" + k[1:]: dialect[k] for k in dialect if k[0] == "'"}
+    if not errors: return
+    def repl(m):
+        return errors.get(m.group(0), m.group(0))
     for b in blocks:
         for e in b.iter():
-            for k in dialect:
-                if k[0] != "'": continue
-                dialect_error = "\u2018" + k[1:]
-                e.text = re.sub("(^|\\W)%s($|\\W)" % dialect_error,
-                                "\\1%s\\2" % dialect[k], e.text)
-                e.tail = re.sub("(^|\\W)%s($|\\W)" % dialect_error,
-                                "\\1%s\\2" % dialect[k], e.tail)
-
-
-def main():
-    et.register_namespace("", "http://www.w3.org/1999/xhtml")
-    args = parse_command_line()
-    text = open(args["filename"], encoding="utf-8").read()
-    text = fix_entities(text)
-    tree = et.XML(text)
+            if e.text: e.text = re_dialect_error.sub(repl, e.text)
+            if e.tail: e.tail = re_dialect_error.sub(repl, e.tail)
+
+
+def process_tree(tree, args):
+    """Runs all of the passes over the tree under the root element tree,
+    args being as returned by parse_command_line. args["filename"] is only
+    used to name the journal and the book."""
+    body = tree.find(".//{http://www.w3.org/1999/xhtml}body")
+    pool = None
+    if args.get("jobs") > 1:
+        pool = multiprocessing.Pool(args["jobs"])
     if args.get("uncurl"):
         rmap = (
             [r"\s?–\s?", "—"],
@@ -276,44 +617,71 @@ def main():
             [r"[‘’]", "'"],
             [r"\{(['\"])\}", "\\1"]
         )
-        replace_text(tree.find(".//{http://www.w3.org/1999/xhtml}body"), rmap)
+        replace_text(body, compile_rules(rmap), pool)
+    #the remaining passes are combined into a single traversal of the body
+    mark_rmap, ellipses_rmap, dashes_rmap = (), (), ()
     if not args.get("skip_curl"):
         #process the tree into a list of blocks to process
         blocks = build_block_list(tree, args)
         #process the blocks
-        dialect = {}
-        ble = len(blocks)
-        for c, se in enumerate(blocks):
-            print(c + 1, "of", ble)
-            curlify_element(se, dialect, args.get("skip_quote_count"))
+        dialect, lex, book = {}, None, None
+        if args.get("lexicon"):
+            lex = lexicon.Lexicon(args["lexicon"])
+            book = args.get("book") or os.path.basename(
+                os.path.dirname(os.path.abspath(args["filename"])))
+            dialect = lex.dialect_forms(book)
+            print("Loaded", len(dialect), "dialect forms from", args["lexicon"])
+        known_dialect = set(dialect)
+        #without a file the journal still serves --replay-only, --batch and
+        #the lexicon, and reuses answers within the run
+        journal_filename = None
+        if not args.get("no_journal"):
+            journal_filename = args.get("journal") or args["filename"] + ".journal"
+        journal = Journal(journal_filename, args.get("replay_only"))
+        if args.get("batch") and not args.get("replay_only"):
+            batch_query(blocks, dialect, journal)
+        curlify_blocks(blocks, dialect, args.get("skip_quote_count"), journal, pool)
+        journal.close()
+        print("Replayed", journal.replayed, "answers,",
+              journal.unresolved, "quotes left unresolved")
+        if lex:
+            lex.record_book(book, journal.answers)
+            lex.close()
         #one more round of dialect replacement to catch fixable errors
         fix_dialect_errors(blocks, dialect)
-        print("Dialect: ", " : ".join(sorted(dialect.keys())))
-        rmap = (
+        print("Dialect: ", " : ".join(sorted(set(dialect) - known_dialect)))
+        mark_rmap = (
             #mark remaining straight quotes and replace apostrophes with right singles
             ['"', '{"}', 0], ["'", "{'}", 0], ["\u02bc", "\u2019"]
         )
-        replace_text(tree.find(".//{http://www.w3.org/1999/xhtml}body"), rmap)
-        print("Need to fix", rmap[0][2], rmap[0][1], "and",
-              rmap[1][2], rmap[1][1])
     if not args.get("skip_ellipses"):
         print("Fixing ellipses")
-        rmap = (
+        ellipses_rmap = (
             [r"\s?\.\s?\.\s?\.\s?\.", "…."],
             [r"\.\s?\.\s?\.", "…"],
             [r"…\s+([”’])", "… \\1"]
         )
-        replace_text(tree.find(".//{http://www.w3.org/1999/xhtml}body"), rmap)
     if not args.get("skip_dashes"):
         print("Fixing dashes")
-        rmap = (
+        dashes_rmap = (
             ["(----)|(——)", "&dmdash;"],
             ["--", "—"],
             ["—", " – "], [r"– (\w)", "– \\1"],
             ["([“‘])–", "\\1 –"], ["–([”’])", "– \\1"],
             ["&dmdash;", "——"]
         )
-        replace_text(tree.find(".//{http://www.w3.org/1999/xhtml}body"), rmap)
+    replace_text(body, compile_rules(mark_rmap, ellipses_rmap, dashes_rmap), pool)
+    if pool: pool.close()
+    if mark_rmap:
+        print("Need to fix", mark_rmap[0][2], mark_rmap[0][1], "and",
+              mark_rmap[1][2], mark_rmap[1][1])
+
+
+def main():
+    et.register_namespace("", "http://www.w3.org/1999/xhtml")
+    args = parse_command_line()
+    tree = common.parse_xhtml(args["filename"]).getroot()
+    process_tree(tree, args)
     #output file
     c, backup_filename = 0, args["filename"] + ".old"
     while os.path.exists(backup_filename):
@@ -3,6 +3,10 @@
 import xml.etree.ElementTree as ET
 import sys
 import argparse
+import array
+import collections
+import common
+import bspindex
 
 title_page_template = """\
 <div id="title_page" xmlns="http://www.w3.org/1999/xhtml">
@@ -13,29 +17,158 @@ title_page_template = """\
 """
 
 
-def process_bsps(r, bsp_dict):
-    out = ET.Element(r.tag, r.attrib)
-    def recursive_process(e, cur):
-        for c, se in enumerate(list(e)):
-            if (se.tag == "{http://www.w3.org/1999/xhtml}div" and
-                se.attrib.get("class") == "bsp_block"):
-                bsps = se.text.strip().split("…")
-                if len(bsps) == 2:
-                    #generate bsp list
-                    bsp_start_i = int(bsps[0][3:]) + 1
-                    bsp_end_i = int(bsps[1][3:])
-                    del bsps[1]
-                    for i in range(bsp_start_i, bsp_end_i + 1):
-                        bsps.append("bsp" + str(i))
-                for bsp in bsps:
-                    cur.append(bsp_dict[bsp])
+def bsp_numbers(text):
+    """Yields the numbers of the bsps that a bsp_block marker, of the form
+    bspN or bspN…bspM, stands for."""
+    first, sep, last = text.strip().partition("…")
+    start = int(first[3:])
+    yield from range(start, int(last[3:]) + 1 if sep else start + 1)
+
+
+def recombine(args, bsps):
+    """Streams the skeleton to the output file, dropping the skeleton
+    headers, adding the title page and replacing each bsp_block marker
+    with the bsps it stands for, which are fetched from bsps (a
+    bspindex.BspFile) as they are needed. Returns an array of the number
+    of times each bsp was used, indexed by bsp number, and a list of the
+    bsp numbers referred to that are not in bsps."""
+    out = common.StreamWriter()
+    uses, unknown = array.array("l", [0]) * bsps.count, []
+    head = skip = title_tag = author_tag = None
+    #each open element has a frame of the form [element, start tag written,
+    #pending]. pending is (element, written): either the last subelement
+    #closed, whose tail is not yet known, or an element still to be written.
+    stack = []
+    def start_tags():
+        for frame in stack:
+            if not frame[1]:
+                out.start(frame[0], frame[0].text)
+                frame[1] = True
+    def finish_pending(frame):
+        if frame[2] is None: return
+        el, written = frame[2]
+        frame[2] = None
+        if written:
+            out.text(el.tail)
+            frame[0].remove(el)
+        else:
+            start_tags()
+            out.element(el)
+    for event, el in common.iterparse_xhtml(args["skeleton"], ("start", "end")):
+        if skip is not None:
+            if event == "end" and el is skip:
+                if skip.tag == "{http://www.w3.org/1999/xhtml}div":
+                    #bsp_block marker
+                    for n, div in bsps.elements(bsp_numbers("".join(skip.itertext()))):
+                        if div is None:
+                            unknown.append(n)
+                            continue
+                        uses[n] += 1
+                        p = div.find("{http://www.w3.org/1999/xhtml}p")
+                        if p is not None:
+                            start_tags()
+                            out.element(p)
+                stack[-1][0].remove(skip)
+                skip = None
+        elif event == "start":
+            if stack:
+                finish_pending(stack[-1])
+                if ((el.tag == "{http://www.w3.org/1999/xhtml}div" and
+                     el.get("class") == "bsp_block") or
+                    (stack[-1][0] is head and
+                     ((el.tag == "{http://www.w3.org/1999/xhtml}link" and
+                       el.get("href") == "include/skel_styles.css") or
+                      el.tag == "{http://www.w3.org/1999/xhtml}script"))):
+                    skip = el
+                    continue
+            stack.append([el, False, None])
+            if len(stack) == 2 and head is None and el.tag == "{http://www.w3.org/1999/xhtml}head":
+                head = el
+            if len(stack) == 2 and el.tag == "{http://www.w3.org/1999/xhtml}body":
+                if not args.get("notitle"):
+                    stack[-1][2] = ET.XML(title_page_template % (title_tag.text, author_tag.get("content"))), False
+        else:
+            frame = stack[-1]
+            finish_pending(frame)
+            stack.pop()
+            if frame[1]:
+                out.end(el)
             else:
-                n = ET.SubElement(cur, se.tag, se.attrib)
-                n.text = se.text
-                n.tail = se.tail
-                recursive_process(se, n)
-    recursive_process(r, out)
-    return out
+                start_tags()
+                if el.text:
+                    out.start(el, el.text)
+                    out.end(el)
+                else:
+                    out.empty(el)
+            if stack:
+                stack[-1][2] = el, True
+                if stack[-1][0] is head:
+                    if el.tag == "{http://www.w3.org/1999/xhtml}title" and title_tag is None:
+                        title_tag = el
+                    elif (el.tag == "{http://www.w3.org/1999/xhtml}meta" and author_tag is None and
+                          el.get("name") == "author"):
+                        author_tag = el
+    out.close(args["output"])
+    return uses, unknown
+
+
+def recombine_tree(skeleton, bsp_tree, notitle=False):
+    """As recombine, but for a skeleton and bsps that are already parsed.
+    skeleton is changed in place to become the recombined tree. Returns a
+    Counter of the number of times each bsp was used, by bsp number, and a
+    list of the bsp numbers referred to that are not in bsp_tree."""
+    divs = {}
+    for div in bsp_tree.getroot().find("{http://www.w3.org/1999/xhtml}body"):
+        m = bspindex.re_bsp_id.match(div.get("id", ""))
+        if m: divs[int(m.group(1))] = div
+    uses, unknown = collections.Counter(), []
+    head = skeleton.find("{http://www.w3.org/1999/xhtml}head")
+    body = skeleton.find("{http://www.w3.org/1999/xhtml}body")
+    title_tag = head.find("{http://www.w3.org/1999/xhtml}title")
+    author_tag = head.find("{http://www.w3.org/1999/xhtml}meta[@name='author']")
+    #as in recombine, removed elements take their tails with them
+    head[:] = [X for X in head
+               if not ((X.tag == "{http://www.w3.org/1999/xhtml}link" and
+                        X.get("href") == "include/skel_styles.css") or
+                       X.tag == "{http://www.w3.org/1999/xhtml}script")]
+    #the skeleton is walked with an explicit stack, so deep skeletons don't
+    #recurse in Python. Each open element has a frame of the form [element,
+    #iterator over its subelements, new subelements, marker found].
+    stack = [[body, iter(body), [], False]]
+    while stack:
+        frame = stack[-1]
+        se = next(frame[1], None)
+        if se is None:
+            stack.pop()
+            if frame[3]: frame[0][:] = frame[2]
+        elif (se.tag == "{http://www.w3.org/1999/xhtml}div" and
+              se.get("class") == "bsp_block"):
+            frame[3] = True
+            for n in bsp_numbers("".join(se.itertext())):
+                if n not in divs:
+                    unknown.append(n)
+                    continue
+                uses[n] += 1
+                p = divs[n].find("{http://www.w3.org/1999/xhtml}p")
+                if p is not None: frame[2].append(p)
+        else:
+            frame[2].append(se)
+            stack.append([se, iter(se), [], False])
+    if not notitle:
+        body.insert(0, ET.XML(title_page_template % (title_tag.text, author_tag.get("content"))))
+    return uses, unknown
+
+
+def report(uses, unknown, numbers):
+    """Reports the bsps referred to that don't exist and those of numbers
+    that were not used exactly once."""
+    for n in unknown:
+        print("Unknown bsp: bsp%d" % n)
+    for n in numbers:
+        if not uses[n]:
+            print("Missing bsp: bsp%d" % n)
+        elif uses[n] > 1:
+            print("Duplicate bsp: bsp%d used %d times" % (n, uses[n]))
 
 
 def parse_command_line():
@@ -57,31 +190,10 @@ The title page is generated from the title tag and the author meta tag of the sk
 def main():
     ET.register_namespace('', "http://www.w3.org/1999/xhtml")
     args = parse_command_line()
-    main_tree = ET.parse(args["skeleton"])
-    removeids = main_tree.findall(
-        "./{http://www.w3.org/1999/xhtml}head/"
-        "{http://www.w3.org/1999/xhtml}link[@href='include/skel_styles.css']")
-    removeids += main_tree.findall(
-        "./{http://www.w3.org/1999/xhtml}head/{http://www.w3.org/1999/xhtml}script")
-    head = main_tree.find("./{http://www.w3.org/1999/xhtml}head")
-    for r in removeids:
-        head.remove(r)
-    if not args.get("notitle"):
-        title = head.find("{http://www.w3.org/1999/xhtml}title").text
-        author_tag = (head.find("{http://www.w3.org/1999/xhtml}meta[@name='author']") or
-                      head.find("{http://www.w3.org/1999/xhtml}meta[@name='author']"))
-        author = author_tag.attrib.get("content")
-        title_page = ET.XML(title_page_template % (title, author))
-        body = main_tree.find("./{http://www.w3.org/1999/xhtml}body")
-        body.insert(0, title_page)
-    bsp_tree = ET.parse(args["bsps"])
-    bsp_dict = {}
-    for e in bsp_tree.iter("{http://www.w3.org/1999/xhtml}div"):
-        bsp_dict[e.attrib["id"]] = e.find("{http://www.w3.org/1999/xhtml}p")
-    out = process_bsps(main_tree.getroot(), bsp_dict)
-    ET.ElementTree(out).write(args["output"],
-                              encoding="unicode",
-                              xml_declaration=True)
+    bsps = bspindex.BspFile(args["bsps"])
+    uses, unknown = recombine(args, bsps)
+    report(uses, unknown, bsps.numbers())
+    bsps.close()
 
 
 
@@ -6,85 +6,157 @@ import argparse
 import os
 import shutil
 import common
+import docserver
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     #parse arguments
     parser = argparse.ArgumentParser(description="""\
     Converts a tag with optional class to a different tag with a different optional class.
+    Any number of such rules can be given with --rule or in a rules file, and are applied
+    in a single pass in the order: positional rule, --rule rules, rules file.
     Original file is saved with extension .old.""")
     parser.add_argument("input",
                         help="Input file (xhtml format)")
-    parser.add_argument("from",
+    parser.add_argument("from", nargs="?", default=None,
                         help="tagname or tagname.class to convert from (e.g. 'div' or 'div.para').")
     parser.add_argument("to", nargs="?", default=None,
                         help=("tagname or tagname.class to convert to "
                               "(e.g. 'p' or 'p.noindent'). "
                               "If not specified, from tag is removed rather than replaced."))
-    args = vars(parser.parse_args())
+    parser.add_argument("-r", "--rule", action="append", nargs=2, metavar=("FROM", "TO"),
+                        help=("Additional rule, as for from and to, with TO given as '' to "
+                              "remove the tag (multiple allowed)"))
+    parser.add_argument("-f", "--rules-file",
+                        help=("File of rules, one per line as 'from [to]'. Blank lines and "
+                              "lines starting with # are ignored."))
+    clear = parser.add_mutually_exclusive_group()
+    clear.add_argument("-y", "--clear", action="store_const", const=True, dest="clear",
+                       help="Clear the content of removed tags without asking")
+    clear.add_argument("-n", "--keep", action="store_const", const=False, dest="clear",
+                       help="Keep the content of removed tags without asking")
+    args = vars(parser.parse_args(argv))
     if not os.path.isfile(args["input"]):
         print("Error:", args["input"], "is not a file")
         sys.exit(-1)
     return args
 
 
-def make_change_list(itree, f):
-    i = f.split(".")
-    xpath = ".//{http://www.w3.org/1999/xhtml}%s" % i[0]
-    if len(i) == 1:
-        return itree.findall(xpath)
-    elif len(i) == 2:
-        change_list = []
-        for e in itree.findall(xpath):
-            c = e.attrib.get("class", "")
-            if c.find(i[1]) != -1:
-                change_list.append(e)
-        return change_list
+def read_rules_file(filename):
+    rules = []
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            rules.append(line.split())
+    return rules
 
 
-def replace_tags(change_list, to):
+def make_rules(args):
+    """Returns the rules given by the command line arguments as a list of
+    (from, tag, class, to) tuples, tag and class being what from matches
+    (class being a single class token) and to being None for removal."""
+    rule_args = []
+    if args["from"]: rule_args.append([args["from"], args["to"]])
+    rule_args.extend(args["rule"] or [])
+    if args["rules_file"]: rule_args.extend(read_rules_file(args["rules_file"]))
+    rules = []
+    for r in rule_args:
+        if len(r) == 1: r = [r[0], None]
+        i = r[0].split(".")
+        if len(r) != 2 or len(i) > 2 or (r[1] and len(r[1].split(".")) > 2):
+            print("Error: bad rule:", " ".join(X for X in r if X))
+            sys.exit(-1)
+        rules.append((r[0], i[0] or None, i[1] if len(i) == 2 else None, r[1] or None))
+    if not rules:
+        print("Error: no rules given")
+        sys.exit(-1)
+    return rules
+
+
+def apply_rules(index, rules, undo=None):
+    """Applies the rules in order, each one seeing the changes made by
+    earlier ones, just as if they had been applied one after the other.
+    All of the rules are matched through index, so the document is only
+    walked once. Replacements are made immediately; elements to be
+    removed are returned as a change list for each rule. If undo is
+    given, the tag and class of each element are added to it before it is
+    changed, for undo_rules."""
+    change_lists = []
+    for f, tag, cls, to in rules:
+        change_list = index.elements(tag, cls)
+        if undo is not None: undo.extend((e, e.tag, e.get("class")) for e in change_list)
+        if to:
+            replace_tags(index, change_list, to)
+            change_list = []
+        else:
+            #removed tags are out of the index, so later rules don't see them
+            for e in change_list: index.set_tag(e, None)
+        change_lists.append(change_list)
+    return change_lists
+
+
+def undo_rules(index, undo):
+    """Puts back the tags and classes changed by apply_rules."""
+    for e, tag, cls in reversed(undo):
+        index.set_tag(e, tag)
+        index.set(e, "class", cls)
+
+
+def replace_tags(index, change_list, to):
     o = to.split(".")
-    if len(o) == 2:
-        for e in change_list:
-            e.tag = o[0]
-            e.attrib["class"] = o[1]
-    elif len(o) == 1:
-        for e in change_list:
-            e.tag = o[0]
-            if "class" in e.attrib: del e.attrib["class"]
+    for e in change_list:
+        index.set_tag(e, "{http://www.w3.org/1999/xhtml}" + o[0])
+        index.set(e, "class", o[1] if len(o) == 2 else None)
 
 
-def remove_tags(change_list):
-    clear = False
-    content = False
+def ask_clear(change_list, f, ask=input):
     for e in change_list:
         if len(e) or e.text:
-            content = True
             break
-    if content:
-        ans = ""
-        while ans != "y" and ans != "n":
-            ans = input("Removed tag has content. Clear content? [y|n]: ")
-        if ans == "y": clear = True
-    for e in change_list:
-        e.tag = None
+    else:
+        return False
+    ans = ""
+    while ans != "y" and ans != "n":
+        ans = ask("Removed tag %s has content. Clear content? [y|n]: " % f)
+    return ans == "y"
+
+
+def remove_tags(index, change_list, clear):
     if clear:
         for e in change_list:
-            t = e.tail
-            e.clear()
-            e.tail = t
+            index.clear(e)
+
+
+def apply(index, rules, clear, ask=input):
+    """Applies the rules to the tree indexed by index. clear says whether
+    to clear the content of removed tags, None meaning ask with ask. If
+    ask raises an exception, the tree is unchanged."""
+    undo = []
+    try:
+        change_lists = apply_rules(index, rules, undo)
+        #all questions are asked before anything is removed, and if one
+        #goes unanswered the tree is left as it was
+        clear = [False if to else
+                 clear if clear is not None else ask_clear(change_list, f, ask)
+                 for (f, tag, cls, to), change_list in zip(rules, change_lists)]
+    except BaseException:
+        undo_rules(index, undo)
+        raise
+    for change_list, c in zip(change_lists, clear):
+        remove_tags(index, change_list, c)
 
 
 def main():
     ET.register_namespace('', "http://www.w3.org/1999/xhtml")
     args = parse_arguments()
-    shutil.copyfile(args["input"], args["input"] + ".old")
+    rules = make_rules(args)
+    if docserver.run("replace_tag", {"input": os.path.abspath(args["input"]),
+                                     "rules": rules, "clear": args["clear"]}):
+        return
     itree = common.parse_xhtml(args["input"])
-    change_list = make_change_list(itree, args["from"])
-    if args["to"]:
-        replace_tags(change_list, args["to"])
-    else:
-        remove_tags(change_list)
+    apply(common.DocIndex(itree.getroot()), rules, args["clear"])
+    shutil.copyfile(args["input"], args["input"] + ".old")
     itree.write(args["input"],
             encoding="unicode",
             xml_declaration=True)
@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+
+#Run from the top directory with: python3 -m unittest discover testcases
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pretty_punc
+
+
+class TestReplaceDialect(unittest.TestCase):
+
+    dialect = {"nothin'": "nothinʼ", "doin'": "doinʼ", "'em": "ʼem"}
+
+    def test_words(self):
+        self.assertEqual(pretty_punc.replace_dialect("Let 'em be, he's doin' it.", self.dialect),
+                         "Let ʼem be, he's doinʼ it.")
+
+    def test_after_opening_quote(self):
+        #the opening quote must not hide a dialect word ending in a quote
+        self.assertEqual(pretty_punc.replace_dialect("He said 'nothin' doin' at all.",
+                                                     self.dialect),
+                         "He said 'nothinʼ doinʼ at all.")
+
+    def test_before_closing_quote(self):
+        self.assertEqual(pretty_punc.replace_dialect("'Give 'em' he said", self.dialect),
+                         "'Give ʼem' he said")
+
+    def test_inside_word(self):
+        self.assertEqual(pretty_punc.replace_dialect("x'em nothin'x", self.dialect),
+                         "x'em nothin'x")
+
+
+if __name__ == "__main__": unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+#Run from the top directory with: python3 -m unittest discover testcases
+
+import io
+import os
+import sys
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import common
+import replace_tag
+
+
+def parse(body):
+    return common.parse_xhtml(io.StringIO(
+        '<html xmlns="http://www.w3.org/1999/xhtml"><body>%s</body></html>' % body))
+
+
+def body_of(tree):
+    common.splice_removed(tree.getroot())
+    s = ET.tostring(tree.find("{http://www.w3.org/1999/xhtml}body"), encoding="unicode")
+    return s[s.index(">") + 1:s.rindex("<")]
+
+
+class TestRules(unittest.TestCase):
+
+    def setUp(self):
+        ET.register_namespace('', "http://www.w3.org/1999/xhtml")
+
+    def run_rules(self, body, rules, clear=False):
+        tree = parse(body)
+        rules = [(X[0], X[0].split(".")[0] or None,
+                  X[0].split(".")[1] if "." in X[0] else None, X[1]) for X in rules]
+        replace_tag.apply(common.DocIndex(tree.getroot()), rules, clear)
+        return body_of(tree)
+
+    def test_removal_then_class_only_rule(self):
+        #the removed span must not be matched by the class-only rule
+        self.assertEqual(self.run_rules('<p><span class="x">a</span> <i class="x">b</i></p>',
+                                        [("span.x", None), (".x", "em")]),
+                         '<p>a <em>b</em></p>')
+
+    def test_removal_then_style_lookup(self):
+        tree = parse('<p><span class="x" style="s">a</span></p>')
+        index = common.DocIndex(tree.getroot())
+        span = index.select("span.x")[0]
+        index.set_tag(span, None)
+        self.assertEqual(index.elements(cls="x"), [])
+        self.assertEqual(index.elements(style="s"), [])
+        self.assertNotIn(span, index.elements())
+
+    def test_rules_see_earlier_rules(self):
+        self.assertEqual(self.run_rules('<div class="a">x</div><p>y</p>',
+                                        [("div.a", "p.b"), ("p", "p.c")]),
+                         '<p class="c">x</p><p class="c">y</p>')
+
+    def test_clear(self):
+        self.assertEqual(self.run_rules('<p>a<span>b<i>c</i></span>d</p>',
+                                        [("span", None)], clear=True),
+                         '<p>ad</p>')
+
+    def test_unanswered_question_leaves_tree(self):
+        body = '<p class="a"><span class="x" style="s">a</span><i>b</i></p>'
+        tree = parse(body)
+        index = common.DocIndex(tree.getroot())
+        def ask(prompt): raise EOFError
+        rules = [("p.a", "p", "a", "div.b"), ("span", "span", None, None), ("i", "i", None, "em")]
+        self.assertRaises(EOFError, replace_tag.apply, index, rules, None, ask)
+        self.assertEqual(body_of(tree), body)
+        self.assertEqual(len(index.elements("span", "x", "s")), 1)
+        self.assertEqual(len(index.select("p.a")), 1)
+        self.assertEqual(index.select("div.b"), [])
+
+
+class TestArguments(unittest.TestCase):
+
+    def test_rule_before_input(self):
+        #a --rule takes exactly two arguments, leaving the input alone
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "pretty-punc-test.xhtml")
+        args = replace_tag.parse_arguments(["-r", "span", "", "-r", "div.a", "p",
+                                            filename, "i", "em"])
+        self.assertEqual(args["input"], filename)
+        self.assertEqual(replace_tag.make_rules(args),
+                         [("i", "i", None, "em"), ("span", "span", None, None),
+                          ("div.a", "div", "a", "p")])
+
+
+if __name__ == "__main__": unittest.main()